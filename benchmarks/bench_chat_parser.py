@@ -0,0 +1,115 @@
+"""
+Chat client parser benchmark
+Compares the old per-line parsing (JSON attempt on every frame, ad-hoc
+regexes for the line, link split and alert check) with the precompiled
+single-pass parser in client_discord.py.
+
+The corpus is a recorded chat log segment written by the server
+(chat_logs/chat-*.jsonl). Without one, a seeded corpus shaped like guild
+chat is generated: short lines, #uooutlands locations, alerts, emoji and
+long base64 payloads.
+
+Usage: python benchmarks/bench_chat_parser.py [chat-segment.jsonl] [rounds]
+"""
+import base64
+import json
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import client_discord  # noqa: E402
+
+CORPUS = sys.argv[1] if len(sys.argv) > 1 else None
+ROUNDS = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+USERS = ["Leo", "Wes", "Grimm", "Ashka", "Morrigan", "Tobin", "Vex", "Kael"]
+WORDS = ["pull", "boss", "dungeon", "loot", "rez", "heals", "gate", "wipe",
+         "moongate", "champ", "spawn", "dockmaster", "rune", "gg", "omw", "inc"]
+
+
+def load_corpus(path):
+    """Chat lines as the client receives them: "[author] text" """
+    with open(path, encoding="utf-8") as f:
+        return [f"[{author}] {text}" for _, _, author, text in map(json.loads, f)]
+
+
+def generate_corpus(lines=20000, seed=1337):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(lines):
+        user = rng.choice(USERS)
+        roll = rng.random()
+        if roll < 0.70:
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 14)))
+        elif roll < 0.82:
+            text = (f"at #uooutlands|Felucca|{rng.choice(WORDS)} cave|{rng.randint(-50, 5000)}"
+                    f"|{rng.randint(0, 4000)}|{rng.randint(-20, 80)} come now")
+        elif roll < 0.90:
+            text = f"alert {rng.choice(WORDS)} at the {rng.choice(WORDS)} 🔥"
+        elif roll < 0.97:
+            # Shared loot filters and map pins: a few KB of base64 on one line
+            blob = base64.b64encode(rng.randbytes(rng.randint(1024, 6144))).decode()
+            text = f"import this: {blob}"
+        else:
+            text = "[!ALERT!]"
+        corpus.append(f"[{user}] {text}")
+    return corpus
+
+
+def parse_before(message):
+    """The old path: json.loads attempt, then three separate regex passes"""
+    try:
+        json.loads(message)
+    except json.JSONDecodeError:
+        pass
+    text = message.split("]", 1)[-1]
+    alert = re.search(r"\balert\b", text, re.IGNORECASE) is not None
+    full_line = f"[12:00] {message}\n"
+    match = re.match(r"\[(.*?)\] \[(.*?)\](.*)", full_line)
+    segments = []
+    if match:
+        pattern = r'(#uooutlands\|[^|]+\|[^|]+\|-?\d+\|-?\d+\|-?\d+|[A-Za-z0-9+/=\u0080-\uFFFF]{50,})'
+        for part in re.split(pattern, match.group(3) + "\n"):
+            is_location = part.startswith('#uooutlands')
+            is_base64 = len(part) >= 50 and re.match(r'^[A-Za-z0-9+/=\u0080-\uFFFF]+$', part)
+            segments.append((part, bool(is_location or is_base64)))
+    return alert, segments
+
+
+def parse_after(message):
+    """The new path: sender and text are split once, then one scan for links"""
+    sender, text = client_discord.parse_chat_text(message)
+    alert = client_discord.is_alert(text)
+    return alert, client_discord.split_links(text)
+
+
+def run(name, parse, corpus):
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        for message in corpus:
+            parse(message)
+        best = min(best, time.perf_counter() - start)
+    size = sum(len(m) for m in corpus)
+    print(f"{name:<8} {len(corpus) / best:>12,.0f} lines/s  {size / best / 1e6:>8.1f} MB/s  "
+          f"{best * 1e6 / len(corpus):>7.2f} us/line")
+    return best
+
+
+def main():
+    corpus = load_corpus(CORPUS) if CORPUS else generate_corpus()
+    links_before = sum(is_link for m in corpus for _, is_link in parse_before(m)[1])
+    links_after = sum(is_link for m in corpus for _, is_link in parse_after(m)[1])
+    assert links_before == links_after, (links_before, links_after)
+    print(f"[BENCH] {len(corpus)} chat lines, {links_after} links, "
+          f"{sum(len(m) for m in corpus) / 1e6:.1f} MB, best of {ROUNDS}")
+    before = run("before", parse_before, corpus)
+    after = run("after", parse_after, corpus)
+    print(f"[BENCH] Speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
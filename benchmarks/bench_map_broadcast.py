@@ -0,0 +1,100 @@
+"""
+Map broadcast benchmark
+Compares the old per-recipient json.dumps fan-out with the serialize-once
+BroadcastHub path for a ping sent to 500 simulated map clients.
+
+Usage: python benchmarks/bench_map_broadcast.py [clients] [events]
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server  # noqa: E402
+
+CLIENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+EVENTS  = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+
+class FakeSocket:
+    """Stands in for a map client; only counts the frames it receives"""
+    def __init__(self):
+        self.frames = 0
+
+    async def send_text(self, text):
+        self.frames += 1
+
+
+class CountingEncoder:
+    """Wraps json.dumps so both strategies report how many encodes they did"""
+    def __init__(self, dumps):
+        self.dumps = dumps
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self.dumps(*args, **kwargs)
+
+
+def make_ping(i):
+    return {
+        "type": "ping",
+        "user": f"user{i % 60}",
+        "lat": 3072.5 + i,
+        "lng": 5376.25 - i,
+        "timestamp": 1760000000000 + i,
+    }
+
+
+async def bench_before(sockets):
+    """The original loop: one json.dumps and one awaited send per recipient"""
+    sender = sockets[0]
+    for i in range(EVENTS):
+        ping_data = make_ping(i)
+        for conn in list(sockets):
+            if conn != sender:
+                await conn.send_text(json.dumps(ping_data))
+
+
+async def bench_after(sockets):
+    """BroadcastHub: encode once, queue the same frame for everyone"""
+    hub = server.BroadcastHub("BENCH", queue_size=EVENTS + 1)
+    for conn in sockets:
+        hub.add(conn)
+    sender = sockets[0]
+    for i in range(EVENTS):
+        hub.broadcast_json(make_ping(i), exclude=sender)
+    # Let the writer tasks drain so the send cost is counted too
+    while any(not q.empty() for q in hub.queues.values()):
+        await asyncio.sleep(0)
+    for conn in sockets:
+        hub.discard(conn)
+
+
+def run(name, bench):
+    sockets = [FakeSocket() for _ in range(CLIENTS)]
+    encoder = CountingEncoder(json.dumps)
+    json.dumps = encoder
+    try:
+        start = time.perf_counter()
+        asyncio.run(bench(sockets))
+        elapsed = time.perf_counter() - start
+    finally:
+        json.dumps = encoder.dumps
+    frames = sum(s.frames for s in sockets)
+    print(f"{name:<8} {encoder.calls:>9} encodes  {encoder.calls / elapsed:>12,.0f} encodes/s  "
+          f"{EVENTS / elapsed:>9,.0f} events/s  {frames / elapsed:>12,.0f} frames/s")
+    return elapsed
+
+
+def main():
+    print(f"[BENCH] {EVENTS} pings fanned out to {CLIENTS} map clients")
+    before = run("before", bench_before)
+    after = run("after", bench_after)
+    print(f"[BENCH] Speedup: {before / after:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Map page load benchmark
+Runs the real server app under uvicorn in a child process and hammers the
+map page with concurrent HTTP clients, comparing the old handler (opens and
+reads map_client.html on every request) with the in-memory /map route:
+a first visit (compressed body) and a repeat visit (If-None-Match -> 304).
+Reports requests per second, latency percentiles and bytes on the wire.
+
+The load generator speaks bare keep-alive HTTP/1.1 over asyncio streams so
+it does not become the bottleneck itself.
+
+Usage: python benchmarks/bench_map_load.py [concurrency] [seconds]
+"""
+import asyncio
+import multiprocessing
+import os
+import socket
+import sys
+import time
+import warnings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CONCURRENCY = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+SECONDS     = float(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve(port):
+    """Child process: server.app plus the pre-cache /map handler at /bench/map-legacy"""
+    warnings.simplefilter("ignore")
+    os.chdir(ROOT)  # server.py's default paths (map_client.html, static/, pois.json) are relative to the repo
+    import uvicorn
+    from fastapi.responses import HTMLResponse
+    import server
+
+    async def legacy_map():
+        try:
+            with open(server.MAP_HTML_PATH, "r", encoding="utf-8") as f:
+                content = f.read()
+            return HTMLResponse(content)
+        except FileNotFoundError:
+            return HTMLResponse("<h1>Map client not found</h1>", status_code=404)
+
+    server.app.add_api_route("/bench/map-legacy", legacy_map)
+    uvicorn.run(server.app, host="127.0.0.1", port=port, log_level="warning", access_log=False)
+
+
+async def request(reader, writer, raw):
+    """Send one request and read the response; returns (status, headers, body)"""
+    writer.write(raw)
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    headers = dict(line.lower().split(": ", 1) for line in lines[1:] if line)
+    body = await reader.readexactly(int(headers.get("content-length", 0)))
+    return int(lines[0].split()[1]), headers, body
+
+
+def build_request(path, headers):
+    lines = [f"GET {path} HTTP/1.1", "Host: bench"] + [f"{k}: {v}" for k, v in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def wait_ready(port):
+    for _ in range(300):
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        except OSError:
+            await asyncio.sleep(0.1)
+            continue
+        await request(reader, writer, build_request("/online_count", {}))
+        writer.close()
+        return
+    raise RuntimeError("server did not start")
+
+
+async def load(port, path, headers):
+    latencies = []
+    sizes = []
+    raw = build_request(path, headers)
+    deadline = time.perf_counter() + SECONDS
+
+    async def worker():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            status, _, body = await request(reader, writer, raw)
+            latencies.append(time.perf_counter() - start)
+            sizes.append(len(body))
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(CONCURRENCY)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return len(latencies) / elapsed, latencies, sum(sizes) / len(sizes)
+
+
+async def run(port):
+    await wait_ready(port)
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    _, headers, _ = await request(reader, writer, build_request("/map", {"Accept-Encoding": "gzip"}))
+    writer.close()
+    etag = headers["etag"]
+    cases = [
+        ("legacy open()", "/bench/map-legacy", {"Accept-Encoding": "gzip"}),
+        ("cached first visit", "/map", {"Accept-Encoding": "gzip"}),
+        ("cached revalidate", "/map", {"Accept-Encoding": "gzip", "If-None-Match": etag}),
+    ]
+    results = {}
+    for name, path, headers in cases:
+        rps, latencies, size = await load(port, path, headers)
+        results[name] = rps
+        p50 = latencies[len(latencies) // 2] * 1000
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000
+        print(f"{name:<20} {rps:>9,.0f} req/s  p50 {p50:>6.1f} ms  p99 {p99:>6.1f} ms  {size / 1024:>6.1f} KiB/resp")
+    print(f"[BENCH] Speedup: {results['cached first visit'] / results['legacy open()']:.1f}x first visit, "
+          f"{results['cached revalidate'] / results['legacy open()']:.1f}x revalidate")
+
+
+def main():
+    port = free_port()
+    child = multiprocessing.Process(target=serve, args=(port,), daemon=True)
+    child.start()
+    print(f"[BENCH] {CONCURRENCY} concurrent clients, {SECONDS:g} s per case")
+    try:
+        asyncio.run(run(port))
+    finally:
+        child.terminate()
+        child.join()
+
+
+if __name__ == "__main__":
+    main()
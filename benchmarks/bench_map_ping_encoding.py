@@ -0,0 +1,108 @@
+"""
+Map ping encoding benchmark
+Pushes pings through the /map path in each negotiated encoding, on one
+core: decode the sender's frame, fan it out to every map client through
+BroadcastHub, and decode it again on every receiving client. Reports
+bytes per ping frame and pings per second per core.
+
+Usage: python benchmarks/bench_map_ping_encoding.py [clients] [pings]
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server  # noqa: E402
+
+CLIENTS = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+PINGS   = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+USERS   = 40
+
+
+class FakeSocket:
+    """Stands in for a map client: decodes every frame it receives like map_client.html does"""
+    def __init__(self):
+        self.names = {}
+        self.pings = 0
+        self.ping_bytes = 0
+
+    async def send_text(self, text):
+        data = json.loads(text)
+        if data["type"] == "pings":
+            self.pings += len(data["pings"])
+            self.ping_bytes += len(text.encode("utf-8"))
+
+    async def send_bytes(self, frame):
+        if frame[0] == server.MAP_OP_PINGS:
+            for user_id, lat, lng, timestamp, seq in server.MAP_BATCH_ENTRY.iter_unpack(frame[server.MAP_BATCH_HEADER.size:]):
+                self.names[user_id]  # Resolve the interned name like the client does
+                self.pings += 1
+            self.ping_bytes += len(frame)
+        else:
+            offset = 1
+            while offset < len(frame):
+                user_id, length = server.MAP_USERS_ENTRY.unpack_from(frame, offset)
+                offset += server.MAP_USERS_ENTRY.size
+                self.names[user_id] = frame[offset:offset + length].decode("utf-8")
+                offset += length
+
+
+def inbound_frames(encoding):
+    """What senders put on the wire: JSON objects or packed uplink pings"""
+    frames = []
+    for i in range(PINGS):
+        user, lat, lng, ts = f"raider{i % USERS}", 3072.5 + i % 977, 5376.25 - i % 613, 1760000000000.0 + i
+        if encoding == "bin2":
+            frames.append((user, server.MAP_PING_IN.pack(server.MAP_OP_PING, lat, lng)))
+        else:
+            frames.append((user, json.dumps({"type": "ping", "user": user, "lat": lat, "lng": lng, "timestamp": ts})))
+    return frames
+
+
+async def bench(encoding, sockets, frames):
+    hub = server.BroadcastHub("BENCH", queue_size=PINGS * 2 + USERS + 1)
+    codec = server.MapCodec(hub)
+    for conn in sockets:
+        hub.add(conn)
+        codec.negotiate(conn, [encoding])
+    for seq, (user, frame) in enumerate(frames, 1):
+        if encoding == "bin2":
+            op, lat, lng = server.MAP_PING_IN.unpack(frame)
+        else:
+            data = json.loads(frame)
+            lat, lng = data["lat"], data["lng"]
+        # A batch of one, so this measures the encoding rather than tick aggregation
+        codec.broadcast_pings({user: (lat, lng, time.time() * 1000, seq)})
+    # Let the writer tasks drain so send and client-side decode are counted too
+    while any(not q.empty() for q in hub.queues.values()):
+        await asyncio.sleep(0)
+    for conn in sockets:
+        hub.discard(conn)
+
+
+def run(encoding):
+    sockets = [FakeSocket() for _ in range(CLIENTS)]
+    frames = inbound_frames(encoding)
+    start = time.perf_counter()
+    asyncio.run(bench(encoding, sockets, frames))
+    elapsed = time.perf_counter() - start
+    delivered = sum(s.pings for s in sockets)
+    assert delivered == PINGS * CLIENTS, delivered
+    per_ping = sum(s.ping_bytes for s in sockets) / delivered
+    uplink = sum(len(f) for _, f in frames) / len(frames)
+    print(f"{encoding:<6} {uplink:>6.1f} B up  {per_ping:>6.1f} B down  "
+          f"{PINGS / elapsed:>9,.0f} pings/s/core  {delivered / elapsed:>11,.0f} deliveries/s")
+    return elapsed
+
+
+def main():
+    print(f"[BENCH] {PINGS} pings from {USERS} users fanned out to {CLIENTS} map clients")
+    json_time = run("json")
+    bin_time = run("bin2")
+    print(f"[BENCH] Speedup: {json_time / bin_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Metrics overhead benchmark
+Times one chat message through the /ws path (count it, fan the frame out
+to every socket through a real BroadcastHub, observe the handle time) with
+the real metrics and with no-op stand-ins, alternating message by message,
+and reports the median of each. The metric updates one message makes are
+also timed on their own, without the fan-out. Also times one /metrics
+scrape.
+
+Usage: python benchmarks/bench_metrics_overhead.py [clients] [messages]
+"""
+import asyncio
+import gc
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server  # noqa: E402
+
+CLIENTS  = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+MESSAGES = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+ROUNDS   = 7
+SCRAPES  = 200
+
+
+class FakeSocket:
+    async def send_text(self, text):
+        pass
+
+
+class NoMetric:
+    """Stands in for a counter or histogram; every update is a no-op"""
+    def inc(self, amount=1):
+        pass
+
+    def observe_since(self, started):
+        pass
+
+
+async def run_round(hub, variants, frame, timings):
+    """MESSAGES chat messages, alternating metric variants message by message so drift hits both alike"""
+    for index in range(MESSAGES):
+        name, (queued, counter, histogram) = variants[index % 2]
+        hub.frames_queued = queued
+        start = time.perf_counter()
+        started = time.perf_counter()
+        try:
+            counter.inc()
+            hub.broadcast(frame)
+        finally:
+            histogram.observe_since(started)
+        timings[name].append(time.perf_counter() - start)
+    # Let the writers drain the queues before the next round
+    while any(not q.empty() for q in hub.queues.values()):
+        await asyncio.sleep(0)
+
+
+async def bench():
+    hub = server.BroadcastHub("BENCH", queue_size=MESSAGES + 1)
+    for _ in range(CLIENTS):
+        hub.add(FakeSocket())
+    frame = server.make_frame("chat", {"text": "boss at 20%, heals on tank"}, sender="Raider1", seq=1)
+    real = (hub.frames_queued, server.ws_messages["chat"], server.ws_handle_seconds)
+    variants = [("real", real), ("no-op", (NoMetric(),) * 3)]
+    timings = {"real": [], "no-op": []}
+    for index in range(ROUNDS):
+        await run_round(hub, variants[index % 2:] + variants[:index % 2], frame, timings)
+    hub.frames_queued = real[0]
+    return {name: statistics.median(times) for name, times in timings.items()}
+
+
+def metric_updates(queued, counter, histogram):
+    """Seconds per message for just the updates the /ws path makes: two counters and a histogram"""
+    start = time.perf_counter()
+    for _ in range(MESSAGES * 100):
+        started = time.perf_counter()
+        counter.inc()
+        queued.inc(CLIENTS)
+        histogram.observe_since(started)
+    return (time.perf_counter() - start) / (MESSAGES * 100)
+
+
+def main():
+    print(f"[BENCH] {MESSAGES:,} chat messages fanned out to {CLIENTS} sockets, median over {ROUNDS} rounds")
+    gc.disable()
+    per_message = asyncio.run(bench())
+    for name, seconds in per_message.items():
+        print(f"{name:<6} {seconds * 1e6:>8.2f} us per message")
+    print(f"[BENCH] Overhead: {(per_message['real'] - per_message['no-op']) * 1e6:+.2f} us per message")
+    hub = server.BroadcastHub("BENCH")
+    null = NoMetric()
+    real = metric_updates(hub.frames_queued, server.ws_messages["chat"], server.ws_handle_seconds)
+    baseline = metric_updates(null, null, null)
+    gc.enable()
+    print(f"[BENCH] Metric updates: {real * 1e6:.2f} us per message ({(real - baseline) * 1e6:.2f} us over no-op calls)")
+    start = time.perf_counter()
+    for _ in range(SCRAPES):
+        text = server.metrics.render()
+    elapsed = time.perf_counter() - start
+    print(f"[BENCH] Scrape: {elapsed / SCRAPES * 1e6:.0f} us, {len(text) / 1024:.1f} KiB, "
+          f"{len(server.metrics.families)} families")
+
+
+if __name__ == "__main__":
+    main()
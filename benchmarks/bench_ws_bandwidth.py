@@ -0,0 +1,188 @@
+"""
+WebSocket bandwidth benchmark
+Replays a raid session (chat lines and map pings) through a real uvicorn
+server for each WebSocket setting and counts the bytes that reach the
+client through a TCP proxy, handshake and frame headers included.
+
+The session is a JSONL recording, one event per line:
+  {"type": "chat", "sender": ..., "text": ...}
+  {"type": "ping", "user": ..., "lat": ..., "lng": ..., "timestamp": ...}
+Without one, a seeded 30-minute raid with 25 raiders is generated.
+
+Usage: python benchmarks/bench_ws_bandwidth.py [session.jsonl]
+"""
+import asyncio
+import json
+import os
+import random
+import socket
+import sys
+import warnings
+
+import uvicorn
+import websockets
+from fastapi import FastAPI, WebSocket
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server  # noqa: E402
+
+SESSION = sys.argv[1] if len(sys.argv) > 1 else None
+
+warnings.simplefilter("ignore")  # uvicorn's deprecation notice for the legacy websockets implementation
+
+SETTINGS = [
+    ("websockets", False),
+    ("websockets", True),
+    ("wsproto", False),
+    ("wsproto", True),
+]
+
+RAIDERS = [f"Raider{i}" for i in range(25)]
+CALLOUTS = ["pull in 10", "rez pls", "heals on tank", "gate is up", "inc south", "loot is up",
+            "boss at 20%", "wipe, run back", "drop the pots", "omw", "champ spawn", "gg"]
+
+
+def load_session(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def generate_session(minutes=30, seed=7):
+    """Roughly one chat line every 2 s and bursts of Ctrl+Click pings around each pull"""
+    rng = random.Random(seed)
+    events = []
+    ts = 1760000000000.0
+    for _ in range(minutes * 30):
+        ts += rng.uniform(500, 3500)
+        if rng.random() < 0.6:
+            events.append({"type": "chat", "sender": rng.choice(RAIDERS),
+                           "text": f"{rng.choice(CALLOUTS)} {rng.choice(CALLOUTS) if rng.random() < 0.3 else ''}".strip()})
+        else:
+            x, y = rng.uniform(0, 10752), rng.uniform(0, 6144)
+            for _ in range(rng.randint(1, 12)):
+                ts += rng.uniform(20, 200)
+                events.append({"type": "ping", "user": rng.choice(RAIDERS), "lat": round(y + rng.uniform(-40, 40), 3),
+                               "lng": round(x + rng.uniform(-40, 40), 3), "timestamp": ts})
+    return events
+
+
+def build_streams(events):
+    """Frames exactly as server.py would send them on /ws and on /map (json and bin2)"""
+    chat = []
+    map_json = []
+    map_bin = []
+    codec = server.MapCodec(server.BroadcastHub("BENCH"))
+    tick_ms = server.MAP_PING_TICK * 1000
+
+    def flush(pings):
+        known = len(codec.names)
+        packed, _ = codec.pack_pings(pings)
+        if len(codec.names) > known:
+            map_bin.append(codec.users_frame(known))
+        map_bin.append(packed)
+        map_json.append(codec.json_pings(pings))
+
+    pending = {}
+    tick_end = None
+    for seq, event in enumerate(events, 1):
+        if event["type"] == "chat":
+            chat.append(server.make_frame("chat", {"text": event["text"]}, sender=event["sender"], seq=seq))
+            continue
+        # Group pings into ticks by their timestamps, latest per user, like PingBatcher
+        if tick_end is not None and event["timestamp"] >= tick_end:
+            flush(pending)
+            pending = {}
+        if not pending:
+            tick_end = event["timestamp"] + tick_ms
+        pending.pop(event["user"], None)
+        pending[event["user"]] = (event["lat"], event["lng"], event["timestamp"], seq)
+    if pending:
+        flush(pending)
+    return {"chat /ws": chat, "map json": map_json, "map bin2": map_bin}
+
+
+def make_app(streams):
+    app = FastAPI()
+
+    @app.websocket("/replay/{index}")
+    async def replay(websocket: WebSocket, index: int):
+        await websocket.accept()
+        for frame in list(streams.values())[index]:
+            if isinstance(frame, bytes):
+                await websocket.send_bytes(frame)
+            else:
+                await websocket.send_text(frame)
+        await websocket.close()
+
+    return app
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def counting_proxy(target_port, counter):
+    """Forward TCP to uvicorn, counting server -> client bytes"""
+    async def pipe(reader, writer, count):
+        try:
+            while data := await reader.read(65536):
+                if count:
+                    counter[0] += len(data)
+                writer.write(data)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def handle(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection("127.0.0.1", target_port)
+        await asyncio.gather(pipe(client_reader, server_writer, False),
+                             pipe(server_reader, client_writer, True), return_exceptions=True)
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+async def measure(app, impl, deflate, stream_count):
+    port = free_port()
+    settings = dict(server.WS_SETTINGS, ws=impl, ws_per_message_deflate=deflate)
+    uv = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", **settings))
+    serve_task = asyncio.create_task(uv.serve())
+    while not uv.started:
+        await asyncio.sleep(0.01)
+    results = []
+    try:
+        for index in range(stream_count):
+            counter = [0]
+            proxy = await counting_proxy(port, counter)
+            proxy_port = proxy.sockets[0].getsockname()[1]
+            # The client always offers deflate; the server setting decides
+            async with websockets.connect(f"ws://127.0.0.1:{proxy_port}/replay/{index}",
+                                          max_size=None, compression="deflate") as ws:
+                async for _ in ws:
+                    pass
+            proxy.close()
+            await proxy.wait_closed()
+            results.append(counter[0])
+    finally:
+        uv.should_exit = True
+        await serve_task
+    return results
+
+
+async def run():
+    events = load_session(SESSION) if SESSION else generate_session()
+    streams = build_streams(events)
+    app = make_app(streams)
+    payload = [sum(len(f if isinstance(f, bytes) else f.encode("utf-8")) for f in frames) for frames in streams.values()]
+    print(f"[BENCH] {len(events)} events: " + ", ".join(
+        f"{name} {len(frames)} frames / {size / 1024:.0f} KiB payload" for (name, frames), size in zip(streams.items(), payload)))
+    print(f"{'setting':<24}" + "".join(f"{name:>14}" for name in streams))
+    for impl, deflate in SETTINGS:
+        wire = await measure(app, impl, deflate, len(streams))
+        label = f"{impl} deflate={'on' if deflate else 'off'}"
+        print(f"{label:<24}" + "".join(f"{size / 1024:>10.0f} KiB" for size in wire))
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -8,6 +8,7 @@ import json, os, sys, time, webbrowser, requests, base64, subprocess, tempfile
 from websocket import WebSocketApp
 import re
 from datetime import datetime
+from collections import deque
 import queue
 import concurrent.futures
 
@@ -64,6 +65,15 @@ ENTRY_BG      = "#2b2b2b"
 BUTTON_BG     = "#3a3a3a"
 BUTTON_ACTIVE = "#555555"
 
+# Chat transcript limits
+TRANSCRIPT_MAX_LINES    = 1000   # Lines kept in the chat widget
+TRANSCRIPT_TRIM_CHUNK   = 200    # Lines removed at once when the widget overflows
+TRANSCRIPT_ARCHIVE_SIZE = 20000  # Trimmed messages kept for scroll-back
+
+# UI update pump (WebSocket thread -> Tk main loop)
+UI_PUMP_INTERVAL_MS = 16   # One drain per frame
+UI_PUMP_MAX_BATCH   = 500  # Updates applied per frame at most; the rest wait for the next one
+
 class SoundManager:
     """Robust sound manager with proper resource handling"""
     def __init__(self):
@@ -138,6 +148,105 @@ class SoundManager:
         except Exception:
             pass
 
+class Transcript:
+    """Bookkeeping for the bounded chat view.
+
+    Tracks how many widget lines each rendered entry occupies so the oldest
+    ones can be trimmed in bulk, and keeps trimmed entries in a compact
+    archive that can be rendered back when the user scrolls to the top.
+    Lines rendered back don't count toward max_lines until the view returns
+    to the bottom, so new messages don't trim them while they're being read.
+    Entries are ("line", ts, sender, text) or ("poll", ts, None, text, poll_id);
+    sender is None for lines shown without a name.
+    """
+    def __init__(self, max_lines=TRANSCRIPT_MAX_LINES, trim_chunk=TRANSCRIPT_TRIM_CHUNK,
+                 archive_size=TRANSCRIPT_ARCHIVE_SIZE):
+        self.max_lines = max_lines
+        self.trim_chunk = trim_chunk
+        self.visible = deque()  # (line_count, entry) shown in the widget, oldest first
+        self.visible_lines = 0
+        self.restored_lines = 0  # Lines at the top rendered back from the archive
+        self.archive = deque(maxlen=archive_size)  # Entries trimmed from the widget, oldest first
+
+    def add(self, entry, line_count):
+        self.visible.append((line_count, entry))
+        self.visible_lines += line_count
+
+    def prepend(self, entries_with_lines):
+        """Record entries that were rendered back at the top of the widget"""
+        for line_count, entry in reversed(entries_with_lines):
+            self.visible.appendleft((line_count, entry))
+            self.visible_lines += line_count
+            self.restored_lines += line_count
+
+    def release_restored(self):
+        """The user is back at the bottom; restored lines count like any other from now on"""
+        self.restored_lines = 0
+
+    def needs_trim(self):
+        return self.visible_lines - self.restored_lines > self.max_lines + self.trim_chunk
+
+    def trim(self):
+        """Move the oldest entries to the archive until the view is back to max_lines"""
+        removed = []
+        removed_lines = 0
+        while self.visible and self.visible_lines - removed_lines > self.max_lines:
+            line_count, entry = self.visible.popleft()
+            removed.append(entry)
+            removed_lines += line_count
+        self.visible_lines -= removed_lines
+        self.restored_lines = max(self.restored_lines - removed_lines, 0)
+        # Archived polls come back as plain text lines
+        self.archive.extend(("line",) + entry[1:4] for entry in removed)
+        return removed, removed_lines
+
+    def take_archived(self, count):
+        """Newest archived entries (oldest first) to render back above the view"""
+        taken = []
+        while self.archive and len(taken) < count:
+            taken.append(self.archive.pop())
+        taken.reverse()
+        return taken
+
+# Version of the JSON envelope spoken on /ws (see CHAT PROTOCOL in server.py)
+PROTOCOL_VERSION = 1
+
+# Message parsing, compiled once and shared by every line
+# "[sender] message" for locally generated lines; the message may span several lines
+CHAT_LINE_RE = re.compile(r"\[(.*?)\](.*)", re.DOTALL)
+# Clickable parts of a message:
+# 1. #uooutlands followed by pipe-separated values (can include spaces within values)
+#    Pattern: #uooutlands|value|value|number|number|number (numbers can be negative)
+# 2. Base64-like strings: 50+ chars of alphanumeric + / = and unicode chars
+LINK_RE = re.compile(r"#uooutlands\|[^|]+\|[^|]+\|-?\d+\|-?\d+\|-?\d+|[A-Za-z0-9+/=\u0080-\uFFFF]{50,}")
+ALERT_RE = re.compile(r"\balert\b", re.IGNORECASE)
+
+def split_links(message):
+    """Split message into [(text, is_link), ...] in a single scan"""
+    segments = []
+    pos = 0
+    for match in LINK_RE.finditer(message):
+        start, end = match.span()
+        if start > pos:
+            segments.append((message[pos:start], False))
+        segments.append((match.group(), True))
+        pos = end
+    if pos < len(message):
+        segments.append((message[pos:], False))
+    return segments
+
+def parse_chat_text(text):
+    """Split a locally built "[sender] message" line into (sender, message); sender is None if unformatted"""
+    match = CHAT_LINE_RE.match(text)
+    if not match:
+        return None, text
+    sender, message = match.groups()
+    return sender, message[1:] if message.startswith(" ") else message
+
+def is_alert(text):
+    """True if a chat message mentions an alert"""
+    return ALERT_RE.search(text) is not None
+
 def _decode_jwt(token: str) -> dict:
     try:
         payload_b64 = token.split(".")[1]
@@ -157,6 +266,7 @@ class ChatClient:
         self.max_reconnect_attempts = 10
         self.manual_disconnect = False
         self.reconnect_timer = None
+        self.warned_protocol = False
 
     def start(self):
         scheme = "wss" if SERVER_URL.startswith("https") else "ws"
@@ -164,6 +274,9 @@ class ChatClient:
         
         # Main chat WebSocket (requires authentication)
         ws_url = f"{scheme}://{host}/ws?token={self.token}"
+        if self.gui.last_seq is not None:
+            # Ask the server to replay only what we missed while offline
+            ws_url += f"&since={self.gui.last_seq}"
         self.ws = WebSocketApp(
             ws_url,
             on_open=self.on_open,
@@ -173,20 +286,30 @@ class ChatClient:
         )
         threading.Thread(target=self.ws.run_forever, daemon=True).start()
 
+    # WebSocketApp callbacks run on the run_forever thread; Tk work is handed to the UI pump
+
     def on_open(self, ws):
-        self.reconnect_attempts = 0
-        self.gui.append_text("[System] Connected to chat server.")
-        self.gui.connect_btn.config(text="Disconnect", command=self.gui.disconnect)
+        self.gui.post(self.handle_open)
 
     def on_error(self, ws, error):
-        self.gui.append_text(f"[System] WS Error: {error}")
+        self.gui.post(self.gui.append_text, f"[System] WS Error: {error}")
 
     def on_close(self, ws, code, msg):
+        self.gui.post(self.handle_close, code, msg)
+
+    def on_message(self, ws, message):
+        self.gui.post(self.handle_message, message)
+
+    def handle_open(self):
+        self.reconnect_attempts = 0
+        self.gui.append_text("[System] Connected to chat server.")
+        self.gui.connect_btn.config(text="Disconnect", command=self.gui.disconnect)
+
+    def handle_close(self, code, msg):
         """
         Handle websocket disconnection with auto-reconnect logic.
         
         Args:
-            ws: WebSocket instance
             code: Close code
             msg: Close message
         """
@@ -214,7 +337,7 @@ class ChatClient:
             self.gui.append_text(f"[System] Attempting to reconnect in {delay}s... (Attempt {self.reconnect_attempts}/{self.max_reconnect_attempts})")
             
             # Schedule reconnection
-            self.reconnect_timer = threading.Timer(delay, self.attempt_reconnect)
+            self.reconnect_timer = threading.Timer(delay, self.gui.post, args=(self.attempt_reconnect,))
             self.reconnect_timer.daemon = True
             self.reconnect_timer.start()
         else:
@@ -236,32 +359,64 @@ class ChatClient:
         if self.ws:
             self.ws.send(msg)
 
-    def on_message(self, ws, message):
-        # Check if it's a JSON message (poll data)
+    def send_frame(self, kind, **body):
+        """Send one envelope; the server fills in sender, timestamp and sequence id"""
+        self.send(json.dumps({"v": PROTOCOL_VERSION, "type": kind, "body": body}))
+
+    def handle_message(self, message):
+        # Every frame is a JSON envelope, decoded exactly once here
         try:
-            data = json.loads(message)
-            if data.get("type") == "poll":
-                # New poll created
-                self.gui.display_poll(data["poll_id"], data["question"], data["creator"], data["votes"])
-                return
-            elif data.get("type") == "poll_update":
-                # Poll vote update
-                self.gui.update_poll_votes(data["poll_id"], data["votes"])
-                return
-        except (json.JSONDecodeError, KeyError):
-            # Not a JSON message, treat as regular message
-            pass
-        
-        # Play notification sound using robust sound manager
-        if self.gui.notify_var.get():
-            self.sound_manager.play_sound('notify')
-            
-        # Check for alert keywords and play alert sound
-        text = message.split("]", 1)[-1]
-        if self.gui.alert_var.get() and re.search(r"\balert\b", text, re.IGNORECASE):
-            self.sound_manager.play_sound('alert')
-            
-        self.gui.append_text(message)
+            frame = json.loads(message)
+            kind, body = frame["type"], frame["body"]
+        except (ValueError, TypeError, KeyError):
+            print(f"[WS] Ignoring malformed frame: {message[:80]!r}")
+            return
+        if frame.get("v", PROTOCOL_VERSION) > PROTOCOL_VERSION and not self.warned_protocol:
+            self.warned_protocol = True
+            self.gui.append_text("[System] The server is newer than this client; please update GG Chat.")
+
+        try:
+            if kind == "chat":
+                if frame["seq"] is not None:  # Lines the server couldn't log come without one
+                    self.gui.last_seq = frame["seq"]
+
+                # Play notification sound using robust sound manager
+                if self.gui.notify_var.get():
+                    self.sound_manager.play_sound('notify')
+
+                # Check for alert keywords and play alert sound
+                if self.gui.alert_var.get() and is_alert(body["text"]):
+                    self.sound_manager.play_sound('alert')
+
+                self.gui.append_chat(frame["sender"], body["text"], timestamp=frame["ts"])
+            elif kind == "history":
+                # Batched replay of chat we missed, sent once per connect
+                if body.get("truncated"):
+                    self.gui.append_text("[System] Some messages were missed while offline.")
+                for seq, ts, author, text in body["messages"]:
+                    self.gui.append_chat(author, text, timestamp=ts)
+                self.gui.last_seq = frame["seq"]
+            elif kind == "poll":
+                # New poll created (or an open poll re-sent on connect)
+                if body["poll_id"] in self.gui.active_polls:
+                    self.gui.update_poll_votes(body["poll_id"], body["up"], body["down"])
+                else:
+                    self.gui.display_poll(body["poll_id"], body["question"], body["creator"], body["up"], body["down"])
+            elif kind == "poll_delta":
+                # Votes coalesced by the server, sent as changes to the running tallies
+                self.gui.apply_poll_delta(body["poll_id"], body["up"], body["down"])
+            elif kind == "poll_closed":
+                # Poll expired or was evicted on the server
+                self.gui.close_poll(body["poll_id"])
+            elif kind == "presence":
+                # Snapshot on connect, debounced join/leave deltas afterwards
+                self.gui.users_button.config(text=f"Online: {body['online']}")
+            elif kind == "dkp":
+                # Server pushes our DKP on connect and whenever dkp.yaml changes
+                self.gui.dkp_label.config(text=f"DKP: {body['dkp']}")
+            # Unknown types come from newer servers and are skipped
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"[WS] Malformed {kind} frame: {e}")
     
     def cleanup(self):
         """Clean shutdown of client resources"""
@@ -277,11 +432,18 @@ class ChatGui:
         self.token = None
         self.state = None
         self.user_colors = {}
+        self.name_tags = set()  # user_<name> tags already configured in the text area
         self.is_officer = False
         self.username = None
         self.config = self.load_config()
         self.is_maximized = False
-        self.active_polls = {}  # Track active polls {poll_id: {frame, question, votes, buttons}}
+        self.active_polls = {}  # Track active polls {poll_id: {frame, question, buttons, up, down}}
+        self.poll_frames = {}  # poll_id -> button frame, open or closed, until its lines are trimmed
+        self.last_seq = None  # Sequence id of the last chat line seen, for replay on reconnect
+        self.ui_queue = queue.Queue()  # (callable, args, kwargs) posted from other threads
+        self.pumping = False  # True while the pump batches text widget edits
+        self.last_drained = 0  # Updates applied by the most recent pump frame
+        self.peak_drained = 0  # Largest single-frame drain since startup
 
         self.custom_self_color = self.config.get("self_msg_color", "yellow")
         self.custom_others_color = self.config.get("others_msg_color", FG_COLOR)
@@ -370,10 +532,20 @@ class ChatGui:
         self.text_area.tag_configure("others_msg", foreground=self.custom_others_color, font=("Segoe UI", font_size))
         self.text_area.tag_configure("system_msg", foreground="#00ff00", font=("Segoe UI", font_size, "italic"))
 
-        scrollbar = ttk.Scrollbar(self.text_frame, orient="vertical",
-                                  command=self.text_area.yview, style="Vertical.TScrollbar")
-        scrollbar.grid(row=0, column=1, sticky='ns')
-        self.text_area.config(yscrollcommand=scrollbar.set)
+        # One shared tag for every clickable link; the clicked range is looked up by position
+        self.text_area.tag_configure("link", underline=True, foreground="#00d4ff")
+        self.text_area.tag_bind("link", "<Button-1>", self.on_link_click)
+        self.text_area.tag_bind("link", "<Enter>", lambda e: self.text_area.config(cursor="hand2"))
+        self.text_area.tag_bind("link", "<Leave>", lambda e: self.text_area.config(cursor=""))
+
+        self.transcript = Transcript()
+
+        self.scrollbar = ttk.Scrollbar(self.text_frame, orient="vertical",
+                                       command=self.text_area.yview, style="Vertical.TScrollbar")
+        self.scrollbar.grid(row=0, column=1, sticky='ns')
+        self.text_area.config(yscrollcommand=self.on_text_scroll)
+
+        master.after(UI_PUMP_INTERVAL_MS, self.pump_ui_queue)
 
         entry_frame = tk.Frame(chat_wrapper, bg=BG_COLOR, height=35)
         entry_frame.grid(row=1, column=0, sticky="ew", padx=10, pady=(0, 5))
@@ -403,69 +575,143 @@ class ChatGui:
                 self.save_config()
                 self.token = None
 
-        self.poll_online_users()
-
 
-    def append_text(self, text):
-        ts = datetime.now().strftime("%H:%M")
-        full_line = f"[{ts}] {text}\n"
-        self.text_area.configure(state="normal")
-
-        match = re.match(r"\[(.*?)\] \[(.*?)\](.*)", full_line)
-        if match:
-            timestamp = match.group(1)
-            sender = match.group(2)
-            message = match.group(3) + "\n"
+    def post(self, func, *args, **kwargs):
+        """Queue a UI update from any thread; it runs on the Tk main loop"""
+        self.ui_queue.put((func, args, kwargs))
 
+    def pump_ui_queue(self):
+        """Apply queued updates with one edit/trim/see cycle for the whole frame"""
+        drained = 0
+        if not self.ui_queue.empty():
+            self.pumping = True
+            self.text_area.configure(state="normal")
+            try:
+                while drained < UI_PUMP_MAX_BATCH:
+                    try:
+                        func, args, kwargs = self.ui_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    drained += 1
+                    try:
+                        func(*args, **kwargs)
+                    except Exception as e:
+                        print(f"[UI] Update {getattr(func, '__name__', func)} failed: {e}")
+            finally:
+                self.pumping = False
+                self.trim_transcript()
+                self.text_area.configure(state="disabled")
+                self.text_area.see("end")
+        self.last_drained = drained
+        self.peak_drained = max(self.peak_drained, drained)
+        self.master.after(UI_PUMP_INTERVAL_MS, self.pump_ui_queue)
+
+    def begin_edit(self):
+        if not self.pumping:
+            self.text_area.configure(state="normal")
+
+    def end_edit(self):
+        # Inside the pump these run once per frame instead of once per message
+        if not self.pumping:
+            self.trim_transcript()
+            self.text_area.configure(state="disabled")
+            self.text_area.see("end")
+
+    def append_text(self, text, timestamp=None):
+        """Show a locally built "[sender] message" line"""
+        sender, message = parse_chat_text(text)
+        self.append_chat(sender, message, timestamp)
+
+    def append_chat(self, sender, text, timestamp=None):
+        """Show a chat message; sender and text come straight from the server envelope"""
+        ts = (datetime.fromtimestamp(timestamp) if timestamp else datetime.now()).strftime("%H:%M")
+        self.begin_edit()
+
+        lines_before = self._line_count()
+        self.render_line(ts, sender, text, "end")
+        self.transcript.add(("line", ts, sender, text), self._line_count() - lines_before)
+
+        self.end_edit()
+
+    def render_line(self, ts, sender, text, index):
+        """Insert one formatted chat line at index (a mark with right gravity or "end")"""
+        if sender is not None:
             # Insert timestamp
-            self.text_area.insert("end", f"[{timestamp}] ")
+            self.text_area.insert(index, f"[{ts}] ")
 
             # Insert name with user color tag
             name_tag = f"user_{sender}"
-            if name_tag not in self.text_area.tag_names():
+            if name_tag not in self.name_tags:
                 # Use the custom others color instead of random color
                 self.text_area.tag_configure(name_tag, foreground=self.custom_others_color, font=("Segoe UI", 13, "bold"))
-            self.text_area.insert("end", f"[{sender}]", name_tag)
+                self.name_tags.add(name_tag)
+            self.text_area.insert(index, f"[{sender}]", name_tag)
 
             # Insert message with clickable location links
             msg_tag = "self_msg" if sender.lower() == (self.username or '').lower() else "others_msg"
-            self.insert_message_with_links(message, msg_tag)
+            self.text_area.insert(index, " ", msg_tag)
+            self.insert_message_with_links(split_links(text), msg_tag, index)
         else:
-            self.text_area.insert("end", full_line)
+            self.text_area.insert(index, f"[{ts}] {text}\n")
+
+    def _line_count(self):
+        return int(self.text_area.index("end-1c").split(".")[0])
 
+    def trim_transcript(self):
+        """Drop the oldest lines from the widget in one delete once it overflows"""
+        if not self.transcript.needs_trim():
+            return
+        removed, removed_lines = self.transcript.trim()
+        self.text_area.delete("1.0", f"{removed_lines + 1}.0")
+        for entry in removed:
+            if entry[0] == "poll":
+                # The vote buttons go away with the poll's lines
+                self.active_polls.pop(entry[4], None)
+                frame = self.poll_frames.pop(entry[4], None)
+                if frame:
+                    frame.destroy()
+
+    def load_older_lines(self):
+        """Render a chunk of archived lines back above the current view"""
+        entries = self.transcript.take_archived(self.transcript.trim_chunk)
+        if not entries:
+            return
+        self.text_area.configure(state="normal")
+        self.text_area.mark_set("restore", "1.0")
+        self.text_area.mark_gravity("restore", "right")
+        rendered = []
+        for entry in entries:
+            lines_before = self._line_count()
+            self.render_line(entry[1], entry[2], entry[3], "restore")
+            rendered.append((self._line_count() - lines_before, entry))
+        self.text_area.mark_unset("restore")
+        self.transcript.prepend(rendered)
         self.text_area.configure(state="disabled")
-        self.text_area.see("end")
+        # Keep the line the user was looking at on screen
+        self.text_area.yview(f"{sum(count for count, _ in rendered) + 1}.0")
+
+    def on_text_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        if float(last) >= 1.0:
+            self.transcript.release_restored()
+        if float(first) <= 0.0 and float(last) < 1.0 and self.transcript.archive:
+            self.master.after_idle(self.load_older_lines)
+
+    def on_link_click(self, event):
+        """Copy the link under the mouse; the tag range at the click position is the payload"""
+        start, end = self.text_area.tag_prevrange("link", f"@{event.x},{event.y} + 1c")
+        self.copy_location_to_clipboard(self.text_area.get(start, end))
     
-    def insert_message_with_links(self, message, base_tag):
-        """Insert message text with clickable #uooutlands links and base64 strings"""
-        # Pattern to match:
-        # 1. #uooutlands followed by pipe-separated values (can include spaces within values)
-        #    Pattern: #uooutlands|value|value|number|number|number (numbers can be negative)
-        # 2. Base64-like strings: 50+ chars of alphanumeric + / = and unicode chars
-        pattern = r'(#uooutlands\|[^|]+\|[^|]+\|-?\d+\|-?\d+\|-?\d+|[A-Za-z0-9+/=\u0080-\uFFFF]{50,})'
-        
-        parts = re.split(pattern, message)
-        
-        for part in parts:
-            # Check if it's a #uooutlands string or a long base64-like string
-            is_location = part.startswith('#uooutlands')
-            is_base64 = len(part) >= 50 and re.match(r'^[A-Za-z0-9+/=\u0080-\uFFFF]+$', part)
-            
-            if is_location or is_base64:
-                # Create unique tag for this clickable link
-                link_tag = f"link_{id(part)}_{time.time()}"
-                
-                # Insert the link text with both base formatting and link styling
-                self.text_area.insert("end", part, (base_tag, link_tag))
-                
-                # Configure the link tag with underline and click handler
-                self.text_area.tag_configure(link_tag, underline=True, foreground="#00d4ff")
-                self.text_area.tag_bind(link_tag, "<Button-1>", lambda e, text=part: self.copy_location_to_clipboard(text))
-                self.text_area.tag_bind(link_tag, "<Enter>", lambda e, tag=link_tag: self.text_area.config(cursor="hand2"))
-                self.text_area.tag_bind(link_tag, "<Leave>", lambda e: self.text_area.config(cursor=""))
+    def insert_message_with_links(self, segments, base_tag, index="end"):
+        """Insert parsed message segments; #uooutlands locations and base64 strings are clickable"""
+        for part, is_link in segments:
+            if is_link:
+                # Insert the link text with both base formatting and the shared link tag
+                self.text_area.insert(index, part, (base_tag, "link"))
             else:
                 # Regular text with base formatting
-                self.text_area.insert("end", part, base_tag)
+                self.text_area.insert(index, part, base_tag)
+        self.text_area.insert(index, "\n", base_tag)
     
     def copy_location_to_clipboard(self, text):
         """Copy location/base64 text to clipboard silently"""
@@ -476,9 +722,10 @@ class ChatGui:
         except Exception as e:
             print(f"Failed to copy to clipboard: {e}")
     
-    def display_poll(self, poll_id, question, creator, votes):
+    def display_poll(self, poll_id, question, creator, up_votes, down_votes):
         """Display a poll in the chat"""
-        self.text_area.configure(state="normal")
+        self.begin_edit()
+        lines_before = self._line_count()
         
         # Add poll header
         ts = datetime.now().strftime("%H:%M")
@@ -492,10 +739,6 @@ class ChatGui:
         # Insert vote buttons as text (we'll use window_create for actual buttons)
         button_frame = tk.Frame(self.text_area, bg=ENTRY_BG, relief=tk.RAISED, bd=2, padx=5, pady=5)
         
-        # Vote counts
-        up_votes = sum(1 for v in votes.values() if v == "up")
-        down_votes = sum(1 for v in votes.values() if v == "down")
-        
         # Thumbs up button
         up_btn = tk.Button(button_frame, text=f"👍 {up_votes}", bg=BUTTON_BG, fg="#00ff00", 
                           activebackground=BUTTON_ACTIVE, font=("Segoe UI", 10, "bold"),
@@ -513,42 +756,53 @@ class ChatGui:
         self.text_area.insert("end", "\n\n")
         
         # Store poll info for updates
+        self.poll_frames[poll_id] = button_frame
         self.active_polls[poll_id] = {
             "frame": button_frame,
             "up_btn": up_btn,
             "down_btn": down_btn,
             "question": question,
-            "votes": votes
+            "up": up_votes,
+            "down": down_votes
         }
+
+        # Once trimmed, the poll is archived as its header line only
+        entry = ("poll", ts, None, f"📊 Poll by {creator}: {question}", poll_id)
+        self.transcript.add(entry, self._line_count() - lines_before)
         
-        self.text_area.configure(state="disabled")
-        self.text_area.see("end")
+        self.end_edit()
     
-    def update_poll_votes(self, poll_id, votes):
+    def update_poll_votes(self, poll_id, up_votes, down_votes):
         """Update vote counts for an existing poll"""
         if poll_id not in self.active_polls:
             return
         
         poll = self.active_polls[poll_id]
-        poll["votes"] = votes
-        
-        # Calculate vote counts
-        up_votes = sum(1 for v in votes.values() if v == "up")
-        down_votes = sum(1 for v in votes.values() if v == "down")
+        poll["up"] = up_votes
+        poll["down"] = down_votes
         
         # Update button text
         poll["up_btn"].config(text=f"👍 {up_votes}")
         poll["down_btn"].config(text=f"👎 {down_votes}")
     
+    def apply_poll_delta(self, poll_id, up_delta, down_delta):
+        """Add a server delta to a poll's running counters"""
+        poll = self.active_polls.get(poll_id)
+        if poll:
+            self.update_poll_votes(poll_id, poll["up"] + up_delta, poll["down"] + down_delta)
+    
+    def close_poll(self, poll_id):
+        """Disable voting on a poll the server has closed"""
+        poll = self.active_polls.pop(poll_id, None)
+        if not poll:
+            return
+        poll["up_btn"].config(state="disabled")
+        poll["down_btn"].config(state="disabled")
+    
     def vote_poll(self, poll_id, vote):
         """Send a vote for a poll"""
         if self.client and self.client.ws:
-            vote_data = json.dumps({
-                "type": "poll_vote",
-                "poll_id": poll_id,
-                "vote": vote
-            })
-            self.client.send(vote_data)
+            self.client.send_frame("poll_vote", poll_id=poll_id, vote=vote)
 
     def get_user_color(self, username):
         return f"user_{username}"
@@ -1135,34 +1389,6 @@ if __name__ == "__main__":
         except Exception as e:
             print(f"Failed to copy to clipboard: {e}")
 
-    def poll_online_users(self):
-        def fetch():
-            try:
-                resp = requests.get("http://45.79.137.244:8801/online_count", timeout=5)
-                if resp.ok:
-                    count = resp.json().get("online", 0)
-                    self.users_button.config(text=f"Online: {count}")
-            except Exception as e:
-                print(f"Failed to fetch online count: {e}")
-            finally:
-                self.master.after(15000, self.poll_online_users)
-        threading.Thread(target=fetch, daemon=True).start()
-    
-    def poll_dkp(self):
-        def fetch():
-            try:
-                if self.username:
-                    resp = requests.get(f"http://45.79.137.244:8800/dkp?username={self.username}", timeout=5)
-                    if resp.ok:
-                        dkp = resp.json().get("dkp", 0)
-                        self.dkp_label.config(text=f"DKP: {dkp}")
-            except Exception as e:
-                print(f"Failed to fetch DKP: {e}")
-            finally:
-                # Poll DKP every 5 minutes (300000 ms)
-                self.master.after(300000, self.poll_dkp)
-        threading.Thread(target=fetch, daemon=True).start()
-
     def load_config(self):
         try:
             return json.load(open(CONFIG_FILE))
@@ -1238,8 +1464,8 @@ if __name__ == "__main__":
                 self.save_config()
                 payload = _decode_jwt(token)
                 self.username = payload.get('username')
-                self.append_text("[System] Authentication successful!")
-                self.start_chat()
+                self.post(self.append_text, "[System] Authentication successful!")
+                self.post(self.start_chat)
                 break
 
     def start_chat(self):
@@ -1250,8 +1476,6 @@ if __name__ == "__main__":
         # Reset manual disconnect flag for new connection
         self.client.manual_disconnect = False
         self.client.start()
-        # Start polling for DKP
-        self.poll_dkp()
 
     def disconnect(self):
         """
@@ -1283,17 +1507,13 @@ if __name__ == "__main__":
             if msg.startswith('/poll '):
                 question = msg[6:].strip()
                 if question:
-                    # Send poll creation request as JSON
-                    poll_data = json.dumps({
-                        "type": "poll_create",
-                        "question": question
-                    })
-                    self.client.send(poll_data)
+                    # Send poll creation request
+                    self.client.send_frame("poll_create", question=question)
                     if not custom:
                         self.entry.delete(0, tk.END)
                 return
             
-            self.client.send(msg)
+            self.client.send_frame("chat", text=msg)
             if not custom:
                 self.entry.delete(0, tk.END)
 
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Offline tile generator for GG Map
+Cuts the full map image into a zoom pyramid of 256-px PNG tiles laid out for
+Leaflet's CRS.Simple, as served by the /tiles/{z}/{x}/{y} route in server.py.
+
+Zoom 0 is the source image at native size (1 map unit = 1 px); every level
+below halves it, down to the level where the whole map fits in one tile.
+Tiles are written to <output>/<z>/<x>/<y>.png. Because CRS.Simple puts the
+map's bottom edge (lat 0) at pixel y 0, tile rows are negative.
+
+Requires Pillow (pip install pillow).
+
+Usage: python make_tiles.py <source.png> [output_dir]
+"""
+import math
+import os
+import sys
+
+from PIL import Image
+
+TILE_SIZE = 256
+
+
+def tile_range(size):
+    """Tile indices covering [0, size) along x"""
+    return range(0, math.ceil(size / TILE_SIZE))
+
+
+def write_level(image, zoom, output_dir):
+    """Cut one zoom level; the image's top edge sits at pixel y = -height"""
+    width, height = image.size
+    count = 0
+    for x in tile_range(width):
+        column_dir = os.path.join(output_dir, str(zoom), str(x))
+        os.makedirs(column_dir, exist_ok=True)
+        for y in range(math.floor(-height / TILE_SIZE), 0):
+            # Image row where this tile starts; negative rows are above the map and stay transparent
+            top = y * TILE_SIZE + height
+            left = x * TILE_SIZE
+            tile = Image.new("RGBA", (TILE_SIZE, TILE_SIZE), (0, 0, 0, 0))
+            tile.paste(image.crop((left, max(top, 0), min(left + TILE_SIZE, width), min(top + TILE_SIZE, height))),
+                       (0, max(-top, 0)))
+            tile.save(os.path.join(column_dir, f"{y}.png"), optimize=True)
+            count += 1
+    return count
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: make_tiles.py <source.png> [output_dir]")
+        sys.exit(1)
+
+    source = sys.argv[1]
+    output_dir = sys.argv[2] if len(sys.argv) > 2 else "tiles"
+
+    image = Image.open(source).convert("RGBA")
+    print(f"[TILES] {source}: {image.width}x{image.height}")
+    zoom = 0
+    while True:
+        count = write_level(image, zoom, output_dir)
+        print(f"[TILES] z={zoom}: {image.width}x{image.height}, {count} tiles")
+        if image.width <= TILE_SIZE and image.height <= TILE_SIZE:
+            break
+        image = image.resize((max(image.width // 2, 1), max(image.height // 2, 1)), Image.LANCZOS)
+        zoom -= 1
+    print(f"[TILES] Wrote zoom levels {zoom}..0 to {output_dir}")
+
+
+if __name__ == "__main__":
+    main()
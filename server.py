@@ -5,11 +5,32 @@ import asyncio
 import uvicorn
 import httpx
 import json
+import gzip
+import hashlib
+import math
+import mimetypes
+import re
+import sqlite3
+import struct
+import threading
 import yaml
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import islice
+from operator import itemgetter
 
-from fastapi import FastAPI, Request, WebSocket
-from fastapi.responses import HTMLResponse
-from fastapi.staticfiles import StaticFiles
+try:
+    from yaml import CSafeLoader as DKPLoader  # libyaml-backed, much faster on big files
+except ImportError:
+    from yaml import SafeLoader as DKPLoader
+
+try:
+    import brotli  # Optional: static assets get .br variants only when it is installed
+except ImportError:
+    brotli = None
+
+from fastapi import FastAPI, Request, Response, WebSocket
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse
 from jose import jwt, JWTError
 
 import discord
@@ -24,50 +45,1659 @@ BOT_TOKEN     = os.environ.get("DISCORD_BOT_TOKEN")
 REDIRECT_URI  = os.environ.get("REDIRECT_URI", "http://localhost:8888/callback")
 JWT_SECRET    = os.environ.get("JWT_SECRET", secrets.token_urlsafe(32))
 DKP_FILE_PATH = os.environ.get("DKP_FILE_PATH", "/root/GG_Discord/GGDiscordBot/cogs/dkp.yaml")
+BROADCAST_QUEUE_SIZE = int(os.environ.get("BROADCAST_QUEUE_SIZE", "256"))  # Frames buffered per socket before it is dropped
+DKP_CHECK_INTERVAL   = float(os.environ.get("DKP_CHECK_INTERVAL", "5"))  # Seconds between dkp.yaml stat checks
+CHAT_HISTORY_SIZE    = int(os.environ.get("CHAT_HISTORY_SIZE", "500"))  # Chat lines kept in memory for replay
+CHAT_HISTORY_REPLAY  = int(os.environ.get("CHAT_HISTORY_REPLAY", "50"))  # Lines replayed to a client that has never connected
+CHAT_LOG_DIR         = os.environ.get("CHAT_LOG_DIR", "chat_logs")  # Append-only chat segments + search index
+CHAT_LOG_SEGMENT_BYTES = int(os.environ.get("CHAT_LOG_SEGMENT_BYTES", str(8 * 1024 * 1024)))  # Rotate segments past this size
+CHAT_LOG_FLUSH_INTERVAL = float(os.environ.get("CHAT_LOG_FLUSH_INTERVAL", "0.5"))  # Seconds between batched log writes
+CHAT_LOG_MAX_PENDING = int(os.environ.get("CHAT_LOG_MAX_PENDING", "50000"))  # Lines kept for retry while log writes fail; the oldest are dropped past this
+POLL_TTL             = float(os.environ.get("POLL_TTL", "3600"))  # Seconds a poll stays open
+POLL_MAX_OPEN        = int(os.environ.get("POLL_MAX_OPEN", "50"))  # Oldest polls are closed past this many
+POLL_SNAPSHOT_PATH   = os.environ.get("POLL_SNAPSHOT_PATH", "polls.json")  # Open polls survive restarts through this file
+POLL_VOTE_TICK       = float(os.environ.get("POLL_VOTE_TICK", "0.1"))  # Seconds of votes coalesced into one poll_delta frame
+POLL_SWEEP_INTERVAL  = float(os.environ.get("POLL_SWEEP_INTERVAL", "10"))  # Seconds between expiry sweeps / snapshots
+PRESENCE_DEBOUNCE    = float(os.environ.get("PRESENCE_DEBOUNCE", "1.0"))  # Seconds to collect joins/leaves before broadcasting
+DISCORD_BATCH_WINDOW = float(os.environ.get("DISCORD_BATCH_WINDOW", "0.5"))  # Seconds to coalesce chat before relaying
+DISCORD_QUEUE_SIZE   = int(os.environ.get("DISCORD_QUEUE_SIZE", "1000"))  # Messages waiting for Discord before new ones are dropped
+MAP_PING_TICK        = float(os.environ.get("MAP_PING_TICK", "0.05"))  # Seconds of map pings batched into one frame per client
+MAP_GRID_CELL        = float(os.environ.get("MAP_GRID_CELL", "512"))  # Map pixels per side of a viewport index cell
+MAP_VIEW_MARGIN      = float(os.environ.get("MAP_VIEW_MARGIN", "256"))  # Pixels around a viewport that still count as in view
+MAP_ACK_SAMPLE       = int(os.environ.get("MAP_ACK_SAMPLE", "16"))  # Map clients ack every Nth ping (by seq) for latency stats; 0 disables
+TILES_DIR            = os.environ.get("TILES_DIR", "tiles")  # Output of make_tiles.py
+TILE_CACHE_SECONDS   = int(os.environ.get("TILE_CACHE_SECONDS", str(7 * 24 * 3600)))  # Browser cache lifetime for map tiles
+ASSETS_DIR           = os.environ.get("ASSETS_DIR", "static")  # Files served under /static (map image, sounds, scripts)
+LEGACY_ASSETS_DIR    = os.environ.get("LEGACY_ASSETS_DIR", ".")  # Where /static/ggmap.png and light.wav used to be served from
+ASSET_CHECK_INTERVAL = float(os.environ.get("ASSET_CHECK_INTERVAL", "2"))  # Seconds between mtime checks of assets and map_client.html
+ASSET_MEMORY_LIMIT   = int(os.environ.get("ASSET_MEMORY_LIMIT", str(2 * 1024 * 1024)))  # Compressible files up to this size are served from memory
+MAP_HTML_PATH        = os.environ.get("MAP_HTML_PATH", "map_client.html")
+POI_FILE_PATH        = os.environ.get("POI_FILE_PATH", "pois.json")  # Map points of interest, {layer: [{name, x, y}]}
+POI_GRID_CELL        = float(os.environ.get("POI_GRID_CELL", "256"))  # Map pixels per side of a POI index cell
+WS_IMPL              = os.environ.get("WS_IMPL", "auto")  # WebSocket implementation: auto, websockets, websockets-sansio or wsproto
+WS_PER_MESSAGE_DEFLATE = os.environ.get("WS_PER_MESSAGE_DEFLATE", "1").lower() in ("1", "true", "yes")  # Offer permessage-deflate
+WS_MAX_SIZE          = int(os.environ.get("WS_MAX_SIZE", str(1024 * 1024)))  # Largest incoming message in bytes
+WS_PING_INTERVAL     = float(os.environ.get("WS_PING_INTERVAL", "20"))  # Seconds between keepalive pings (0 disables them)
+WS_PING_TIMEOUT      = float(os.environ.get("WS_PING_TIMEOUT", "20"))  # Seconds to wait for a pong before dropping the socket
+
+if WS_IMPL not in ("auto", "websockets", "websockets-sansio", "wsproto"):
+    print(f"[WS] Unknown WS_IMPL {WS_IMPL!r}, using auto")
+    WS_IMPL = "auto"
+
+# Passed to uvicorn.Config; shared by /ws and /map
+WS_SETTINGS = {
+    "ws": WS_IMPL,
+    "ws_per_message_deflate": WS_PER_MESSAGE_DEFLATE,
+    "ws_max_size": WS_MAX_SIZE,
+    "ws_ping_interval": WS_PING_INTERVAL or None,
+    "ws_ping_timeout": WS_PING_TIMEOUT or None,
+}
 
 # Check if Discord integration is enabled
 DISCORD_ENABLED = all([CLIENT_ID, CLIENT_SECRET, GUILD_ID, BOT_TOKEN, CHANNEL_ID])
 
+# === METRICS ===
+# Counters, gauges and histograms exposed on /metrics in Prometheus' text
+# format. Labels are bound when a metric is created, so the hot paths only
+# touch attributes (an add, or a bisect and three adds for a histogram) and
+# never look anything up; everything runs on the one event loop, so there are
+# no locks either.
+DURATION_BOUNDS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+                   0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Seconds
+
+class Counter:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.value
+
+class Sampled:
+    """Counter or gauge whose value is read from elsewhere when /metrics is scraped"""
+    __slots__ = ("fn",)
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def get(self):
+        return self.fn()
+
+class Histogram:
+    """Count of observations per fixed upper bound, plus their sum"""
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds=DURATION_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Last slot: above every bound
+        self.sum = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def observe_since(self, started, clock=time.perf_counter):
+        """Record the seconds since a time.perf_counter() reading; observe() inlined, as this runs per message"""
+        value = clock() - started
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+def format_labels(labels, **extra):
+    pairs = {**labels, **extra}
+    if not pairs:
+        return ""
+    escaped = {key: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for key, value in pairs.items()}
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped.items()) + "}"
+
+class Metrics:
+    """Registry of metric families, rendered on demand for /metrics"""
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.families = {}  # name -> (type, help, [(labels, metric, scale)])
+
+    def add(self, kind, name, help_text, metric, labels=None, scale=1.0):
+        family = self.families.setdefault(name, (kind, help_text, []))
+        family[2].append((labels or {}, metric, scale))
+        return metric
+
+    def counter(self, name, help_text, fn=None, **labels):
+        return self.add("counter", name, help_text, Sampled(fn) if fn else Counter(), labels)
+
+    def gauge(self, name, help_text, fn, **labels):
+        return self.add("gauge", name, help_text, Sampled(fn), labels)
+
+    def histogram(self, name, help_text, bounds=DURATION_BOUNDS, **labels):
+        return self.add("histogram", name, help_text, Histogram(bounds), labels)
+
+    def render(self):
+        lines = []
+        for name, (kind, help_text, samples) in self.families.items():
+            full = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full} {help_text}")
+            lines.append(f"# TYPE {full} {kind}")
+            for labels, metric, scale in samples:
+                if kind != "histogram":
+                    lines.append(f"{full}{format_labels(labels)} {metric.get()}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.bounds, metric.counts):
+                    cumulative += count
+                    lines.append(f"{full}_bucket{format_labels(labels, le=f'{bound * scale:g}')} {cumulative}")
+                lines.append(f"{full}_bucket{format_labels(labels, le='+Inf')} {metric.count}")
+                lines.append(f"{full}_sum{format_labels(labels)} {metric.sum * scale}")
+                lines.append(f"{full}_count{format_labels(labels)} {metric.count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics("ggchat")
+METRICS_STARTED = time.time()
+metrics.gauge("start_time_seconds", "Unix time the server started", lambda: METRICS_STARTED)
+
+# === BROADCAST HUB ===
+def encode_frame(payload):
+    """Serialize a payload into a text frame that can be shared by every recipient"""
+    return json.dumps(payload, separators=(",", ":"))
+
+class BroadcastHub:
+    """Fans text (str) and binary (bytes) frames out to a set of WebSockets concurrently.
+
+    Every socket gets its own bounded outbound queue drained by a dedicated
+    writer task, so a slow client only ever delays itself. A socket whose
+    queue fills up is considered too far behind and is dropped.
+    """
+    def __init__(self, name, queue_size=BROADCAST_QUEUE_SIZE):
+        self.name = name
+        self.queue_size = queue_size
+        self.queues = {}   # websocket -> asyncio.Queue of pending frames
+        self.writers = {}  # websocket -> writer task
+        self.frames_queued = metrics.counter("frames_queued_total", "Frames handed to socket queues", hub=name)
+        self.dropped_slow = metrics.counter("sockets_dropped_total", "Sockets dropped by the hub", hub=name, reason="slow")
+        self.dropped_error = metrics.counter("sockets_dropped_total", "Sockets dropped by the hub", hub=name, reason="error")
+        metrics.gauge("connections", "Open WebSockets", self.__len__, hub=name)
+        metrics.gauge("queued_frames", "Frames waiting in socket queues", lambda: sum(q.qsize() for q in self.queues.values()), hub=name)
+
+    def __len__(self):
+        return len(self.queues)
+
+    def __iter__(self):
+        return iter(list(self.queues))
+
+    def __contains__(self, websocket):
+        return websocket in self.queues
+
+    def add(self, websocket):
+        """Register a socket and start its writer task"""
+        if websocket in self.queues:
+            return
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.queues[websocket] = queue
+        self.writers[websocket] = asyncio.create_task(self._writer(websocket, queue))
+
+    def discard(self, websocket):
+        """Unregister a socket and stop its writer task"""
+        self.queues.pop(websocket, None)
+        writer = self.writers.pop(websocket, None)
+        if writer and writer is not asyncio.current_task():
+            writer.cancel()
+
+    def send(self, websocket, text):
+        """Queue a frame for a single socket without waiting on the network"""
+        if self.put(websocket, text):
+            self.frames_queued.inc()
+            return True
+        return False
+
+    def put(self, websocket, text):
+        """send() without the metrics, for fan-out loops that count their frames once"""
+        queue = self.queues.get(websocket)
+        if queue is None:
+            return False
+        try:
+            queue.put_nowait(text)
+            return True
+        except asyncio.QueueFull:
+            print(f"[{self.name}] Dropping slow consumer ({self.queue_size} frames behind)")
+            self.dropped_slow.inc()
+            self.discard(websocket)
+            asyncio.create_task(self._close(websocket))
+            return False
+
+    def broadcast(self, text, exclude=None):
+        """Queue a frame for every socket (optionally skipping one)"""
+        targets = [websocket for websocket in self.queues if websocket is not exclude]
+        for websocket in targets:
+            self.put(websocket, text)
+        self.frames_queued.inc(len(targets))
+
+    def broadcast_json(self, payload, exclude=None):
+        """Encode a payload once and queue the same frame for every socket"""
+        self.broadcast(encode_frame(payload), exclude=exclude)
+
+    async def _writer(self, websocket, queue):
+        try:
+            while True:
+                frame = await queue.get()
+                if isinstance(frame, bytes):
+                    await websocket.send_bytes(frame)
+                else:
+                    await websocket.send_text(frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            if websocket in self.queues:
+                self.dropped_error.inc()
+            self.discard(websocket)
+
+    async def _close(self, websocket):
+        try:
+            await websocket.close(code=1013)  # Try again later
+        except Exception:
+            pass
+
+# === CHAT PROTOCOL ===
+# Every /ws frame is one JSON envelope:
+#   {"v": 1, "type": ..., "seq": ..., "ts": ..., "sender": ..., "body": {...}}
+# Server -> client types: chat, history, poll, poll_delta, poll_closed, presence, dkp.
+# "seq" is the chat sequence id (chat and history only), "ts" is unix seconds.
+# Client -> server frames only need "type" and "body": chat, poll_create, poll_vote.
+PROTOCOL_VERSION = 1
+CLIENT_FRAME_TYPES = ("chat", "poll_create", "poll_vote")
+
+def make_frame(kind, body, sender=None, seq=None, ts=None):
+    """Encode one server -> client envelope"""
+    return encode_frame({
+        "v": PROTOCOL_VERSION,
+        "type": kind,
+        "seq": seq,
+        "ts": int(time.time()) if ts is None else ts,
+        "sender": sender,
+        "body": body,
+    })
+
+def decode_client_frame(text):
+    """Decode a client frame once into (type, body).
+
+    Bare text (and any JSON without a known "type") comes from older clients
+    and is relayed as chat, verbatim; their un-enveloped poll commands are
+    still accepted.
+    """
+    if not text.startswith("{"):
+        return "chat", {"text": text}
+    try:
+        frame = json.loads(text)
+    except json.JSONDecodeError:
+        return "chat", {"text": text}
+    if not isinstance(frame, dict) or frame.get("type") not in CLIENT_FRAME_TYPES:
+        return "chat", {"text": text}
+    body = frame.get("body")
+    return frame["type"], body if isinstance(body, dict) else frame
+
+# === MAP PROTOCOL ===
+# /map clients list the encodings they understand in their join message and
+# the server answers with its pick in user_list. JSON text frames are always
+# understood. Pings go out in batches, one frame per MAP_PING_TICK, as
+# {"type": "pings", "pings": [{user, lat, lng, timestamp, seq}, ...]}; clients
+# skip their own pings. timestamp is when the server received the ping (ms
+# since the epoch, the sender's clock is ignored) and seq numbers pings in
+# that order. A ping's user is always the name joined on the sending socket.
+# user_list also carries "ack_every": the client answers every ping whose seq
+# is a multiple of it with {"type": "ack", "seq", "timestamp", "received"},
+# received being its own clock; the join message's "clock" (the client's
+# Date.now()) lets the server line that clock up with its own.
+# A client may report {"type": "viewport", "bounds": [south, west, north, east], "snap": bool};
+# from then on it only gets pings inside (or near) those bounds, and, if snap
+# is set, {"type": "offscreen", "count", "user", "lat", "lng", "timestamp"}
+# with the newest ping it did not get during a tick.
+# "bin2" additionally carries pings as little-endian binary frames:
+#   server -> client  pings: u8 op=3, u16 count, count x (u16 user_id, f32 lat, f32 lng, f64 timestamp (ms), u32 seq)
+#                     users: u8 op=2, then (u16 user_id, u16 name length, utf-8 name) to the end of the frame;
+#                            the whole table once after user_list, later only new ids, before they are first used
+#   client -> server  ping:  u8 op=1, f32 lat, f32 lng; the user is the joined one
+# ("bin1" was the same without seq and with a client timestamp on pings sent
+# up; clients that only offer it get JSON.)
+MAP_ENCODINGS = ("bin2", "json")  # Server preference order
+MAP_OP_PING = 1
+MAP_OP_USERS = 2
+MAP_OP_PINGS = 3
+MAP_PING_IN = struct.Struct("<Bff")
+MAP_USERS_ENTRY = struct.Struct("<HH")
+MAP_BATCH_HEADER = struct.Struct("<BH")
+MAP_BATCH_ENTRY = struct.Struct("<HffdI")
+MAP_MAX_USER_IDS = 0x10000
+MAP_MAX_NAME_LENGTH = 64  # Characters; longer names are cut on join
+MAP_HEIGHT = 6144  # Map image size in pixels (lat runs 0..MAP_HEIGHT, lng 0..MAP_WIDTH)
+MAP_WIDTH = 10752
+
+class MapCodec:
+    """Interned user ids and packed ping frames for map clients that negotiated "bin2".
+
+    Ids are never reused while the server runs, so every binary client shares
+    one table and a batch is packed once for all of them. Once the id space is
+    exhausted, pings from new names fall back to JSON.
+    """
+    def __init__(self, hub):
+        self.hub = hub
+        self.ids = {}  # username -> user id
+        self.names = []  # user id -> utf-8 name
+        self.table = b""  # Cached "users" frame for the first table_size ids
+        self.table_size = 0
+        self.clients = set()  # sockets that negotiated bin2
+        self.tick_seconds = metrics.histogram("map_tick_seconds", "Time to encode one tick of map pings and queue it for every client")
+
+    def negotiate(self, websocket, offered):
+        """Pick the first server-preferred encoding the client offered"""
+        offered = offered if isinstance(offered, list) else []
+        encoding = next((name for name in MAP_ENCODINGS if name in offered), "json")
+        if encoding == "bin2":
+            self.clients.add(websocket)
+        else:
+            self.clients.discard(websocket)
+        return encoding
+
+    def users_frame(self, start=0):
+        """One "users" frame with every id from start on"""
+        return bytes((MAP_OP_USERS,)) + b"".join(
+            MAP_USERS_ENTRY.pack(user_id, len(name)) + name for user_id, name in enumerate(self.names[start:], start))
+
+    def send_table(self, websocket):
+        """Queue every known user id, as a single frame, for a client that just switched to bin2"""
+        if not self.names:
+            return
+        if self.table_size != len(self.names):
+            self.table = self.users_frame()
+            self.table_size = len(self.names)
+        self.hub.send(websocket, self.table)
+
+    def intern(self, username):
+        """Id for username; None when ids ran out"""
+        user_id = self.ids.get(username)
+        if user_id is None:
+            if len(self.names) >= MAP_MAX_USER_IDS:
+                return None
+            user_id = self.ids[username] = len(self.names)
+            self.names.append(username.encode("utf-8"))
+        return user_id
+
+    def announce(self, usernames):
+        """Intern new names and tell every binary client about them in one frame"""
+        known = len(self.names)
+        for username in usernames:
+            self.intern(username)
+        if len(self.names) > known and self.clients:
+            frame = self.users_frame(known)
+            for websocket in list(self.clients):
+                self.hub.put(websocket, frame)
+            self.hub.frames_queued.inc(len(self.clients))
+
+    def discard(self, websocket):
+        self.clients.discard(websocket)
+
+    def pack_pings(self, pings):
+        """bin2 frame for {user: (lat, lng, timestamp, seq)}, plus the pings whose user could not get an id"""
+        entries = []
+        leftover = {}
+        for user, ping in pings.items():
+            user_id = self.intern(user)
+            if user_id is None:
+                leftover[user] = ping
+            else:
+                entries.append(MAP_BATCH_ENTRY.pack(user_id, *ping))
+        packed = MAP_BATCH_HEADER.pack(MAP_OP_PINGS, len(entries)) + b"".join(entries) if entries else None
+        return packed, leftover
+
+    @staticmethod
+    def json_pings(pings):
+        return encode_frame({"type": "pings", "pings": [
+            {"user": user, "lat": lat, "lng": lng, "timestamp": timestamp, "seq": seq}
+            for user, (lat, lng, timestamp, seq) in pings.items()
+        ]})
+
+    def encode_pings(self, pings, binary):
+        """Frames carrying pings for one encoding"""
+        if not binary:
+            return [self.json_pings(pings)]
+        packed, leftover = self.pack_pings(pings)
+        frames = [packed] if packed else []
+        if leftover:
+            frames.append(self.json_pings(leftover))
+        return frames
+
+    def broadcast_pings(self, pings, views=None):
+        """Send one tick of pings to every map client in its negotiated encoding.
+
+        Clients with a viewport in views only get the pings that fall in it;
+        every distinct (set of pings, encoding) is encoded once and shared.
+        """
+        started = time.perf_counter()
+        self.announce(pings)
+        visible = {}  # websocket -> users whose ping it can see
+        if views is not None and views.views:
+            for user, (lat, lng, *_) in pings.items():
+                for websocket in views.watchers(lat, lng):
+                    visible.setdefault(websocket, []).append(user)
+        frames = {}  # (users or None for all, binary) -> encoded frames
+        summaries = {}
+        queued = 0
+        for websocket in self.hub:
+            users = None
+            if views is not None and websocket in views.views:
+                users = tuple(visible.get(websocket, ()))
+                if websocket in views.snap and len(users) < len(pings):
+                    summary = self._offscreen_summary(websocket, pings, users, summaries)
+                    if summary:
+                        self.hub.put(websocket, summary)
+                        queued += 1
+                if not users:
+                    continue
+            binary = websocket in self.clients
+            batch = frames.get((users, binary))
+            if batch is None:
+                subset = pings if users is None else {user: pings[user] for user in users}
+                batch = frames[users, binary] = self.encode_pings(subset, binary)
+            for frame in batch:
+                self.hub.put(websocket, frame)
+            queued += len(batch)
+        self.hub.frames_queued.inc(queued)
+        self.tick_seconds.observe_since(started)
+
+    @staticmethod
+    def _offscreen_summary(websocket, pings, users, cache):
+        """Newest ping this client did not get (ignoring its own), for snap-to-ping"""
+        own = getattr(websocket, "user_data", {}).get("username")
+        seen = set(users)
+        if own in pings:
+            seen.add(own)  # Its own ping isn't news to it, wherever it landed
+        for user in reversed(pings):
+            if user not in seen:
+                count = len(pings) - len(seen)
+                frame = cache.get((user, count))
+                if frame is None:
+                    lat, lng, timestamp, seq = pings[user]
+                    frame = cache[user, count] = encode_frame({
+                        "type": "offscreen", "count": count,
+                        "user": user, "lat": lat, "lng": lng, "timestamp": timestamp, "seq": seq,
+                    })
+                return frame
+        return None
+
+class ViewportIndex:
+    """Coarse grid over the map: cell -> sockets whose viewport (plus a margin) covers it.
+
+    Viewports are clamped to the map, so a zoomed-out client costs at most one
+    entry per cell. Sockets that never reported a viewport are not indexed and
+    keep getting every ping.
+    """
+    def __init__(self, cell=MAP_GRID_CELL, margin=MAP_VIEW_MARGIN):
+        self.cell = cell
+        self.margin = margin
+        self.rows = int(MAP_HEIGHT // cell)
+        self.cols = int(MAP_WIDTH // cell)
+        self.cells = {}  # (row, col) -> set of sockets
+        self.views = {}  # socket -> cells it is indexed under
+        self.snap = set()  # sockets that want off-screen summaries
+
+    def _index(self, value, limit):
+        return min(max(int(value // self.cell), 0), limit)
+
+    def key(self, lat, lng):
+        return self._index(lat, self.rows), self._index(lng, self.cols)
+
+    def update(self, websocket, south, west, north, east, snap=False):
+        self.discard(websocket)
+        rows = range(self._index(south - self.margin, self.rows), self._index(north + self.margin, self.rows) + 1)
+        cols = range(self._index(west - self.margin, self.cols), self._index(east + self.margin, self.cols) + 1)
+        cells = [(row, col) for row in rows for col in cols]
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(websocket)
+        self.views[websocket] = cells
+        if snap:
+            self.snap.add(websocket)
+
+    def discard(self, websocket):
+        for cell in self.views.pop(websocket, ()):
+            sockets = self.cells[cell]
+            sockets.discard(websocket)
+            if not sockets:
+                del self.cells[cell]
+        self.snap.discard(websocket)
+
+    def watchers(self, lat, lng):
+        if not (math.isfinite(lat) and math.isfinite(lng)):
+            return ()  # No cell; runs inside the tick flush, so it must not raise
+        return self.cells.get(self.key(lat, lng), ())
+
+class PingBatcher:
+    """Collects map pings for MAP_PING_TICK seconds and sends them as one frame per client.
+
+    Only the latest ping per user within a tick is kept; an earlier one from
+    the same user is superseded before anyone sees it. Pings are stamped with
+    the server's receive time and the next seq as they arrive.
+    """
+    def __init__(self, codec, views=None, tick=MAP_PING_TICK):
+        self.codec = codec
+        self.views = views
+        self.tick = tick
+        self.pending = {}  # username -> (lat, lng, timestamp, seq), in arrival order
+        self.seq = 0  # Last seq handed out
+        self.flush_handle = None
+
+    def add(self, user, lat, lng):
+        self.seq += 1
+        self.pending.pop(user, None)
+        self.pending[user] = (lat, lng, time.time() * 1000, self.seq)
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.tick, self._flush)
+
+    def _flush(self):
+        self.flush_handle = None
+        pings, self.pending = self.pending, {}
+        if pings:
+            self.codec.broadcast_pings(pings, self.views)
+
+# === PING LATENCY ===
+class LatencyHistogram(Histogram):
+    """Latencies in ms, counted into fixed log-spaced buckets.
+
+    observe() is a bisect and a few additions; percentiles are read off the
+    bucket bounds, so they are accurate to one bucket (25%).
+    """
+    BOUNDS = tuple(round(0.5 * 1.25 ** i, 3) for i in range(50))  # 0.5 ms .. ~28 s; above goes to overflow
+
+    def __init__(self):
+        super().__init__(self.BOUNDS)
+        self.max = 0.0
+
+    def observe(self, value):
+        super().observe(value)
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        return round(min(self.BOUNDS[index], self.max) if index < len(self.BOUNDS) else self.max, 3)
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "avg": round(self.sum / self.count, 3) if self.count else None,
+            "p50": self.percentile(0.50),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+            "max": round(self.max, 3),
+        }
+
+class PingLatency:
+    """How long pings take from the server stamping them to a map client receiving them.
+
+    Clients ack a sample of pings (every MAP_ACK_SAMPLE-th seq) with their
+    receive time. Their clock is put on the server's with the offset taken
+    at join, which errs low by however long the join message took to arrive.
+    """
+    def __init__(self):
+        self.all = LatencyHistogram()
+        self.connections = {}  # socket -> [clock offset in ms, LatencyHistogram]
+        metrics.add("histogram", "map_ping_latency_seconds", "Sampled ping latency, server receive to client receive",
+                    self.all, scale=0.001)
+
+    def join(self, websocket, client_clock=None):
+        """Track a client; a missing or malformed clock counts as already in sync"""
+        try:
+            offset = time.time() * 1000 - float(client_clock)
+        except (TypeError, ValueError):
+            offset = 0.0
+        self.connections[websocket] = [offset if math.isfinite(offset) else 0.0, LatencyHistogram()]
+
+    def ack(self, websocket, timestamp, received):
+        entry = self.connections.get(websocket)
+        if entry is None:
+            return
+        latency = max(received + entry[0] - timestamp, 0.0)
+        entry[1].observe(latency)
+        self.all.observe(latency)
+
+    def discard(self, websocket):
+        self.connections.pop(websocket, None)
+
+    def stats(self):
+        return {
+            "ack_every": MAP_ACK_SAMPLE,
+            "all": self.all.snapshot(),
+            "connections": [
+                {"user": getattr(websocket, "user_data", {}).get("username"), "clock_offset": round(offset, 1), **hist.snapshot()}
+                for websocket, (offset, hist) in self.connections.items()
+            ],
+        }
+
+# === DISCORD RELAY ===
+class DiscordRelay:
+    """Outbound Discord queue that coalesces bursts of chat into multi-line messages.
+
+    WebSocket handlers only enqueue; a single background task drains the queue,
+    joins everything that arrives within DISCORD_BATCH_WINDOW into one message
+    and honours Discord's retry-after when it gets rate limited.
+    """
+    MAX_MESSAGE_LENGTH = 2000  # Discord's hard limit per message
+
+    def __init__(self, window=DISCORD_BATCH_WINDOW, queue_size=DISCORD_QUEUE_SIZE):
+        self.window = window
+        self.queue = asyncio.Queue(maxsize=queue_size)  # (enqueued_at, text)
+        self.carry = None  # Item that did not fit in the previous batch
+        self.sent_messages = 0
+        self.sent_batches = 0
+        self.dropped = 0
+        self.rate_limited = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+        self.send_seconds = metrics.histogram("discord_send_seconds", "Duration of one channel.send to Discord")
+        metrics.counter("discord_messages_sent_total", "Chat lines relayed to Discord", lambda: self.sent_messages)
+        metrics.counter("discord_batches_sent_total", "Discord messages sent (batches of chat lines)", lambda: self.sent_batches)
+        metrics.counter("discord_dropped_total", "Chat lines dropped because the relay queue was full", lambda: self.dropped)
+        metrics.counter("discord_rate_limited_total", "Sends Discord rate limited", lambda: self.rate_limited)
+        metrics.gauge("discord_queue_depth", "Chat lines waiting for Discord", self.depth)
+
+    def enqueue(self, text):
+        """Queue a line for Discord without waiting on the network"""
+        try:
+            self.queue.put_nowait((time.monotonic(), text))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            print("[!] Discord relay queue full, dropping message")
+
+    def depth(self):
+        return self.queue.qsize() + (1 if self.carry else 0)
+
+    def stats(self):
+        return {
+            "queue_depth": self.depth(),
+            "sent_messages": self.sent_messages,
+            "sent_batches": self.sent_batches,
+            "dropped": self.dropped,
+            "rate_limited": self.rate_limited,
+            "last_flush_latency": round(self.last_flush_latency, 4),
+            "max_flush_latency": round(self.max_flush_latency, 4),
+            "avg_flush_latency": round(self.total_flush_latency / self.sent_batches, 4) if self.sent_batches else 0.0,
+        }
+
+    async def run(self):
+        """Background task: collect a batch, send it, repeat"""
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._flush(batch)
+            except Exception as e:
+                print(f"[!] Failed to send to Discord: {e}")
+
+    async def _next_batch(self):
+        first = self.carry or await self.queue.get()
+        self.carry = None
+        batch = [first]
+        length = len(first[1])
+        deadline = time.monotonic() + self.window
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if length + 1 + len(item[1]) > self.MAX_MESSAGE_LENGTH:
+                self.carry = item
+                break
+            batch.append(item)
+            length += 1 + len(item[1])
+        return batch
+
+    async def _flush(self, batch):
+        if not channel_ref:
+            return
+        text = "\n".join(line for _, line in batch)
+        while True:
+            started = time.perf_counter()
+            try:
+                await channel_ref.send(text)
+                self.send_seconds.observe_since(started)
+                break
+            except discord.RateLimited as e:
+                retry_after = e.retry_after
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    raise
+                retry_after = float(e.response.headers.get("Retry-After", 1))
+            self.rate_limited += 1
+            print(f"[!] Discord rate limited, retrying in {retry_after:.2f}s")
+            await asyncio.sleep(retry_after)
+
+        latency = time.monotonic() - batch[0][0]
+        self.sent_messages += len(batch)
+        self.sent_batches += 1
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        self.total_flush_latency += latency
+
 # === FASTAPI APP ===
 app = FastAPI()
 oauth_states = {}  # Maps OAuth state -> JWT
-connections  = set()  # WebSocket connections
-map_connections = set()  # Map WebSocket connections
+connections  = BroadcastHub("WS")  # Chat WebSocket connections
+map_connections = BroadcastHub("MAP")  # Map WebSocket connections
+map_codec = MapCodec(map_connections)  # Compact ping encoding for map clients that support it
+map_views = ViewportIndex()  # Which /map clients can see which part of the map
+map_pings = PingBatcher(map_codec, map_views)  # Per-tick ping batches for /map
+map_latency = PingLatency()  # Sampled end-to-end ping latency per /map client
 channel_ref  = None  # Holds Discord channel object once bot is ready
-active_polls = {}  # Maps poll_id -> {question, votes: {username: vote}, creator, timestamp}
-dkp_data = {}  # Cached DKP data {username: points}
-dkp_last_updated = 0  # Timestamp of last DKP file read
+discord_relay = DiscordRelay()  # Outbound WS -> Discord queue
+chat_sockets = {}  # Maps lowercased username -> set of that user's /ws connections
+ws_messages = {kind: metrics.counter("messages_received_total", "WebSocket messages received", endpoint="ws", type=kind)
+               for kind in CLIENT_FRAME_TYPES}
+ws_handle_seconds = metrics.histogram("message_handle_seconds", "Time to handle one received message", endpoint="ws")
+map_messages = {kind: metrics.counter("messages_received_total", "WebSocket messages received", endpoint="map", type=kind)
+                for kind in ("join", "ping", "viewport", "ack", "other")}
+map_handle_seconds = metrics.histogram("message_handle_seconds", "Time to handle one received message", endpoint="map")
+oauth_callbacks = {result: metrics.counter("oauth_callbacks_total", "OAuth callbacks by outcome", result=result)
+                   for result in ("ok", "invalid_state", "token_failed", "not_member", "error")}
+oauth_callback_seconds = metrics.histogram("oauth_callback_seconds", "OAuth callback duration, Discord round trips included")
+chat_unrecorded = metrics.counter("chat_unrecorded_total", "Chat lines relayed without a seq because the log's id reservation couldn't be extended")
 
-# Mount static files for serving map assets
-app.mount("/static", StaticFiles(directory="."), name="static")
+# === WATCHED FILES ===
+class WatchedFile:
+    """A file parsed into memory and re-parsed only when its (mtime_ns, size) changes.
 
-# === DKP FUNCTIONS ===
-def load_dkp_data():
-    """Load DKP data from YAML file"""
-    global dkp_data, dkp_last_updated
-    try:
-        if os.path.exists(DKP_FILE_PATH):
-            with open(DKP_FILE_PATH, 'r') as f:
-                dkp_data = yaml.safe_load(f) or {}
-            dkp_last_updated = time.time()
-            print(f"[DKP] Loaded {len(dkp_data)} DKP entries")
+    The file is stat'ed at most every check_interval seconds; a change is
+    parsed in a worker thread and swapped in whole. If parsing fails the
+    last good copy keeps being served and the next check retries. A
+    missing file swaps in _empty(). Subclasses provide _parse and _swap.
+    """
+    tag = "FILE"
+    parse_errors = (OSError, ValueError)
+
+    def __init__(self, path, check_interval):
+        self.path = path
+        self.check_interval = check_interval
+        self.signature = None  # What the loaded copy was built from
+        self.last_checked = 0.0
+        self.lock = asyncio.Lock()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _signature(self):
+        """Changes whenever the parsed copy would; None if the file is missing"""
+        return self._stat()
+
+    def _parse(self):
+        raise NotImplementedError
+
+    def _swap(self, signature, data):
+        raise NotImplementedError
+
+    def _empty(self):
+        return {}
+
+    def _failed(self, error):
+        print(f"[{self.tag}] Error loading {self.path}: {error}")
+
+    def load(self):
+        """Blocking load, used once at startup before the event loop runs"""
+        signature = self._signature()
+        if signature is None:
+            print(f"[{self.tag}] File not found: {self.path}")
+            return
+        try:
+            self._swap(signature, self._parse())
+        except self.parse_errors as e:
+            self._failed(e)
+
+    async def refresh(self):
+        """Reload off the event loop if the file changed"""
+        now = time.monotonic()
+        if now - self.last_checked < self.check_interval:
+            return
+        self.last_checked = now
+        async with self.lock:
+            signature = self._signature()
+            if signature == self.signature:
+                return
+            if signature is None:
+                print(f"[{self.tag}] File not found: {self.path}")
+                self._swap(None, self._empty())
+                return
+            try:
+                data = await asyncio.to_thread(self._parse)
+            except self.parse_errors as e:
+                self._failed(e)
+                return
+            self._swap(signature, data)
+
+# === STATIC ASSETS ===
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml", "audio/wav", "audio/x-wav")
+STATIC_URL_RE = re.compile(r"/static/([\w./-]+)")
+HASHED_CACHE_CONTROL = "public, max-age=31536000, immutable"  # Content-hashed URLs never change content
+PLAIN_CACHE_CONTROL = "public, max-age=300"  # Unhashed URLs from older pages
+LEGACY_ASSETS = ("ggmap.png", "light.wav")  # Still picked up from LEGACY_ASSETS_DIR when missing from ASSETS_DIR
+
+def build_asset(path, data, media_type):
+    """Cacheable response body: ETag from the content hash, plus gzip/brotli variants for text-like types"""
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    variants = {}
+    if media_type.startswith(COMPRESSIBLE_TYPES):
+        variants["gzip"] = gzip.compress(data, compresslevel=9, mtime=0)
+        if brotli is not None:
+            variants["br"] = brotli.compress(data, quality=11)
+        # A variant that doesn't save anything is not worth the Content-Encoding
+        variants = {encoding: body for encoding, body in variants.items() if len(body) < len(data)}
+    return {
+        "path": path,
+        "hash": digest,
+        "media_type": media_type,
+        "body": data,
+        "variants": variants,
+    }
+
+def pick_encoding(request, variants):
+    """Best precompressed variant the client accepts (brotli over gzip), or None for identity"""
+    accepted = {part.split(";")[0].strip() for part in request.headers.get("accept-encoding", "").split(",")}
+    for encoding in ("br", "gzip"):
+        if encoding in variants and encoding in accepted:
+            return encoding
+    return None
+
+def etag_matches(header, etag):
+    """If-None-Match check: header is "*" or a comma-separated list of tags, compared weakly (W/ ignored)"""
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+def asset_response(request, asset, cache_control):
+    """200/304 for an asset, using the precompressed variant the client accepts"""
+    encoding = pick_encoding(request, asset["variants"])
+    etag = f'"{asset["hash"]}-{encoding}"' if encoding else f'"{asset["hash"]}"'
+    headers = {"Cache-Control": cache_control, "ETag": etag, "Vary": "Accept-Encoding"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    if asset["body"] is None:
+        # Too big (or not compressible) to keep in memory
+        return FileResponse(asset["path"], media_type=asset["media_type"], headers=headers)
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        return Response(asset["variants"][encoding], media_type=asset["media_type"], headers=headers)
+    return Response(asset["body"], media_type=asset["media_type"], headers=headers)
+
+class AssetStore:
+    """Files under ASSETS_DIR, served from /static behind content-hashed URLs.
+
+    url(name) gives /static/<name>.<hash>.<ext>; since that URL changes with
+    the content, it can be cached for a year. Compressible files up to
+    ASSET_MEMORY_LIMIT are kept in memory with their variants. The directory
+    is re-checked at most every ASSET_CHECK_INTERVAL seconds and only changed
+    files are re-read (in a worker thread). LEGACY_ASSETS missing from the
+    directory are looked up in legacy_directory, so older installs that keep
+    ggmap.png next to server.py keep working.
+    """
+    def __init__(self, directory=ASSETS_DIR, legacy_directory=LEGACY_ASSETS_DIR, check_interval=ASSET_CHECK_INTERVAL):
+        self.directory = directory
+        self.legacy_directory = legacy_directory
+        self.check_interval = check_interval
+        self.assets = {}  # name relative to directory -> asset
+        self.hashed = {}  # hashed name -> name
+        self.signatures = {}  # name -> (mtime_ns, size) of the loaded file
+        self.version = 0  # Bumped whenever any URL changes
+        self.last_checked = 0.0
+        self.lock = asyncio.Lock()
+
+    def _list(self):
+        found = {}
+        for root, _, files in os.walk(self.directory):
+            for filename in files:
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, self.directory).replace(os.sep, "/")
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                found[name] = (st.st_mtime_ns, st.st_size)
+        for name in LEGACY_ASSETS:
+            if name in found:
+                continue
+            path = os.path.join(self.legacy_directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            found[name] = (st.st_mtime_ns, st.st_size, path)  # The path makes a move into the directory count as a change
+        return found
+
+    def _path(self, name):
+        path = os.path.join(self.directory, name)
+        if name in LEGACY_ASSETS and not os.path.exists(path):
+            return os.path.join(self.legacy_directory, name)
+        return path
+
+    def _build(self, name, signature):
+        path = self._path(name)
+        media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if signature[1] > ASSET_MEMORY_LIMIT:
+            # Too big to keep in memory (the map image): hash it in chunks and serve it from disk
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+            asset = {"path": path, "hash": digest.hexdigest()[:12], "media_type": media_type, "body": None, "variants": {}}
         else:
-            print(f"[DKP] File not found: {DKP_FILE_PATH}")
-            dkp_data = {}
-    except Exception as e:
-        print(f"[DKP] Error loading DKP data: {e}")
-        dkp_data = {}
-
-def get_user_dkp(username):
-    """Get DKP for a specific user"""
-    # Refresh DKP data if it's older than 5 minutes
-    if time.time() - dkp_last_updated > 300:  # 5 minutes
-        load_dkp_data()
-    
-    return dkp_data.get(username.lower(), 0)
+            with open(path, "rb") as f:
+                asset = build_asset(path, f.read(), media_type)
+        stem, ext = os.path.splitext(name)
+        asset["url"] = f"/static/{stem}.{asset['hash']}{ext}"
+        return asset
+
+    def _scan(self):
+        """Blocking: rebuild changed files; returns (assets, hashed, signatures) or None if nothing changed"""
+        found = self._list()
+        if found == self.signatures:
+            return None
+        assets = {}
+        for name, signature in found.items():
+            if self.signatures.get(name) == signature:
+                assets[name] = self.assets[name]
+                continue
+            try:
+                assets[name] = self._build(name, signature)
+            except OSError as e:
+                print(f"[ASSETS] Error reading {name}: {e}")
+        hashed = {asset["url"][len("/static/"):]: name for name, asset in assets.items()}
+        return assets, hashed, found
+
+    def _swap(self, result):
+        self.assets, self.hashed, self.signatures = result
+        self.version += 1
+        print(f"[ASSETS] {len(self.assets)} static assets ready from {self.directory}")
+
+    def load(self):
+        """Blocking load, used once at startup before the event loop runs"""
+        result = self._scan()
+        if result:
+            self._swap(result)
+
+    async def refresh(self):
+        now = time.monotonic()
+        if now - self.last_checked < self.check_interval:
+            return
+        self.last_checked = now
+        async with self.lock:
+            result = await asyncio.to_thread(self._scan)
+            if result:
+                self._swap(result)
+
+    def url(self, name):
+        asset = self.assets.get(name)
+        return asset["url"] if asset else f"/static/{name}"
+
+    def lookup(self, name):
+        """(asset, cache_control) for a hashed or plain name, or (None, None)"""
+        if name in self.hashed:
+            return self.assets[self.hashed[name]], HASHED_CACHE_CONTROL
+        if name in self.assets:
+            return self.assets[name], PLAIN_CACHE_CONTROL
+        return None, None
+
+class MapPage(WatchedFile):
+    """map_client.html kept in memory and re-read only when its mtime changes.
+
+    /static URLs in the page are rewritten to their content-hashed form, so
+    the page is also rebuilt whenever an asset changes.
+    """
+    tag = "MAP"
+
+    def __init__(self, path, assets, check_interval=ASSET_CHECK_INTERVAL):
+        super().__init__(path, check_interval)
+        self.assets = assets
+        self.page = None
+
+    def _signature(self):
+        file_signature = self._stat()
+        return None if file_signature is None else (file_signature, self.assets.version)
+
+    def _parse(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            html = f.read()
+        html = STATIC_URL_RE.sub(lambda m: self.assets.url(m.group(1)), html)
+        return build_asset(self.path, html.encode("utf-8"), "text/html; charset=utf-8")
+
+    def _swap(self, signature, page):
+        self.page = page
+        self.signature = signature
+
+    def _empty(self):
+        return None
+
+    async def get(self):
+        """The current page as an asset, or None if the file is missing"""
+        await self.assets.refresh()
+        await self.refresh()
+        return self.page
+
+asset_store = AssetStore()
+asset_store.load()
+map_page = MapPage(MAP_HTML_PATH, asset_store)
+
+# === POI STORE ===
+def parse_bbox(text):
+    """"min_x,min_y,max_x,max_y" in map pixels -> tuple; raises ValueError"""
+    min_x, min_y, max_x, max_y = box = tuple(float(part) for part in text.split(","))
+    if not all(map(math.isfinite, box)) or min_x > max_x or min_y > max_y:
+        raise ValueError("bad bbox")
+    return box
+
+class POIStore(WatchedFile):
+    """Map points of interest per layer, reloaded only when pois.json changes.
+
+    Each layer gets a grid index (POI_GRID_CELL pixels per cell) so a bbox
+    query only visits the cells it overlaps, and a content hash that /pois
+    uses as its ETag: a layer whose points didn't change is never sent twice.
+    Coordinates are map pixels with y growing downwards, as in the game.
+    """
+    tag = "POI"
+    parse_errors = (OSError, ValueError, KeyError, TypeError)
+
+    def __init__(self, path, cell=POI_GRID_CELL, check_interval=ASSET_CHECK_INTERVAL):
+        super().__init__(path, check_interval)
+        self.cell = cell
+        self.layers = {}  # {layer: {"pois", "grid", "cells", "version", "asset"}}
+
+    def _index(self, name, pois):
+        grid = {}
+        for poi in pois:
+            grid.setdefault((int(poi["x"] // self.cell), int(poi["y"] // self.cell)), []).append(poi)
+        body = json.dumps({"layer": name, "pois": pois}, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        asset = build_asset(self.path, body, "application/json")
+        return {
+            "pois": pois,
+            "grid": grid,
+            # Occupied cell range, so a huge bbox doesn't walk empty cells
+            "cells": (min(cx for cx, _ in grid), min(cy for _, cy in grid),
+                      max(cx for cx, _ in grid), max(cy for _, cy in grid)) if grid else None,
+            "version": asset["hash"],
+            "asset": asset,
+        }
+
+    def _parse(self):
+        with open(self.path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+        return {name: self._index(name, [{"name": str(p["name"]), "x": p["x"], "y": p["y"]} for p in pois])
+                for name, pois in raw.items()}
+
+    def _swap(self, signature, layers):
+        self.layers = layers
+        self.signature = signature
+        print(f"[POI] Loaded {sum(len(layer['pois']) for layer in layers.values())} POIs in {len(layers)} layers")
+
+    def query(self, name, bbox):
+        """POIs of a layer inside bbox (min_x, min_y, max_x, max_y), edges included"""
+        layer = self.layers[name]
+        if layer["cells"] is None:
+            return []
+        min_x, min_y, max_x, max_y = bbox
+        first_cx, first_cy, last_cx, last_cy = layer["cells"]
+        grid = layer["grid"]
+        found = []
+        for cx in range(max(int(min_x // self.cell), first_cx), min(int(max_x // self.cell), last_cx) + 1):
+            for cy in range(max(int(min_y // self.cell), first_cy), min(int(max_y // self.cell), last_cy) + 1):
+                for poi in grid.get((cx, cy), ()):
+                    if min_x <= poi["x"] <= max_x and min_y <= poi["y"] <= max_y:
+                        found.append(poi)
+        return found
+
+poi_store = POIStore(POI_FILE_PATH)
+poi_store.load()
+
+# === DKP STORE ===
+class DKPStore(WatchedFile):
+    """DKP points keyed by lowercased username, reloaded only when dkp.yaml changes.
+
+    The file is checked every DKP_CHECK_INTERVAL seconds. The parsed dict
+    is swapped in whole, so readers never see a half-loaded table.
+    """
+    tag = "DKP"
+    parse_errors = (Exception,)  # Anything the YAML loader raises
+
+    def __init__(self, path, check_interval=DKP_CHECK_INTERVAL):
+        super().__init__(path, check_interval)
+        self.data = {}  # {lowercased username: points}
+        self.listeners = []  # Called with {username: points} for every entry a reload changed
+        self.reload_seconds = metrics.histogram("dkp_reload_seconds", "Time to read and parse dkp.yaml")
+        self.reload_errors = metrics.counter("dkp_reload_errors_total", "dkp.yaml reloads that failed")
+        metrics.gauge("dkp_entries", "Users in the DKP table", lambda: len(self.data))
+
+    def _parse(self):
+        started = time.perf_counter()
+        with open(self.path, "r") as f:
+            raw = yaml.load(f, Loader=DKPLoader) or {}
+        data = {str(name).lower(): points for name, points in raw.items()}
+        self.reload_seconds.observe_since(started)
+        return data
+
+    def _swap(self, signature, data):
+        old = self.data
+        self.data = data
+        self.signature = signature
+        print(f"[DKP] Loaded {len(data)} DKP entries")
+
+        changed = {name: data.get(name, 0) for name in old.keys() | data.keys() if old.get(name) != data.get(name)}
+        if changed:
+            for listener in self.listeners:
+                listener(changed)
+
+    def _failed(self, error):
+        self.reload_errors.inc()
+        super()._failed(error)
+
+    def get(self, username):
+        """Get DKP for a specific user"""
+        return self.data.get(username.lower(), 0)
+
+    def get_many(self, usernames):
+        """Get DKP for several users from a single snapshot of the table"""
+        data = self.data
+        return {name: data.get(name.lower(), 0) for name in usernames}
+
+def push_dkp_updates(changed):
+    """Send a dkp frame to the /ws sockets of every connected user whose points changed"""
+    for name, points in changed.items():
+        for conn in chat_sockets.get(name, ()):
+            connections.send(conn, make_frame("dkp", {"dkp": points}))
+
+async def watch_dkp():
+    """Background task: pick up dkp.yaml edits even when nobody hits /dkp"""
+    while True:
+        await asyncio.sleep(dkp_store.check_interval)
+        try:
+            await dkp_store.refresh()
+        except Exception as e:
+            print(f"[DKP] Watcher error: {e}")
+
+dkp_store = DKPStore(DKP_FILE_PATH)
+dkp_store.listeners.append(push_dkp_updates)
 
 # Load DKP data on startup
-load_dkp_data()
+dkp_store.load()
+
+# === PRESENCE ===
+class Presence:
+    """Unique online users on /ws, with debounced join/leave broadcasts.
+
+    Only JWT-verified chat users are counted; /map names are whatever the
+    client typed, so they stay out. Users are counted once no matter how many
+    sockets they hold open. Joins and leaves are collected for
+    PRESENCE_DEBOUNCE seconds and sent as one delta, and a leave followed by
+    a re-join inside that window cancels out.
+    """
+    def __init__(self, hub, debounce=PRESENCE_DEBOUNCE):
+        self.hub = hub
+        self.debounce = debounce
+        self.sessions = {}  # lowercased username -> number of open sockets
+        self.names = {}  # lowercased username -> display name
+        self.joined = {}  # Pending delta: lowercased username -> display name
+        self.left = {}
+        self.flush_handle = None
+
+    def count(self):
+        return len(self.sessions)
+
+    def snapshot(self):
+        return make_frame("presence", {"online": self.count(), "users": sorted(self.names.values(), key=str.lower)})
+
+    def join(self, username):
+        key = username.lower()
+        open_sockets = self.sessions.get(key, 0)
+        self.sessions[key] = open_sockets + 1
+        if open_sockets:
+            return
+        self.names[key] = username
+        if self.left.pop(key, None) is None:
+            self.joined[key] = username
+        self._schedule()
+
+    def leave(self, username):
+        key = username.lower()
+        open_sockets = self.sessions.get(key, 0)
+        if open_sockets > 1:
+            self.sessions[key] = open_sockets - 1
+            return
+        self.sessions.pop(key, None)
+        name = self.names.pop(key, username)
+        if self.joined.pop(key, None) is None:
+            self.left[key] = name
+        self._schedule()
+
+    def _schedule(self):
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.debounce, self._flush)
+
+    def _flush(self):
+        self.flush_handle = None
+        if not self.joined and not self.left:
+            return
+        self.hub.broadcast(make_frame("presence", {
+            "online": self.count(),
+            "joined": list(self.joined.values()),
+            "left": list(self.left.values()),
+        }))
+        self.joined = {}
+        self.left = {}
+
+presence = Presence(connections)
+
+# === CHAT LOG ===
+class ChatLog:
+    """Durable append-only chat log with an SQLite FTS5 search index.
+
+    Lines are buffered in memory and written in batches from a worker thread
+    every CHAT_LOG_FLUSH_INTERVAL seconds: appended as JSON records to the
+    current segment file (rotated at CHAT_LOG_SEGMENT_BYTES) and inserted into
+    the full-text index in the same pass, so searches never scan the segments.
+
+    Sequence ids are reserved SEQ_RESERVE ahead in the index, and a restart
+    resumes past the reservation: ids handed out for lines that were still
+    buffered when the process died are never given out again. No id past
+    the reservation is handed out (see can_assign) until extending it has
+    been written. While writes fail, at most CHAT_LOG_MAX_PENDING lines are
+    kept for retry; older ones are dropped and counted.
+    """
+    SEQ_RESERVE = 10000
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.pending = []  # (seq, ts, author, text) waiting for the next flush
+        self.db = None
+        self.write_lock = threading.Lock()
+        self.read_lock = threading.Lock()
+        self.reader = None
+        self.segment = None
+        self.segment_path = None
+        self.reserved_seq = 0  # Ids up to here may be in use; persisted in the index
+        self.last_seq = 0  # Newest id handed out
+        self.dropped = metrics.counter("chat_log_dropped_total", "Chat lines dropped after log writes kept failing")
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        index_path = os.path.join(self.directory, "index.sqlite3")
+        self.db = sqlite3.connect(index_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5(author, text, ts UNINDEXED)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value INTEGER)")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'reserved_seq'").fetchone()
+        logged = self.db.execute("SELECT max(rowid) FROM messages").fetchone()[0] or 0
+        self.start_seq = self.last_seq = max(logged, row[0] if row else 0)
+        self._reserve(self.start_seq + self.SEQ_RESERVE)
+        self.db.commit()
+        self.reader = sqlite3.connect(index_path, check_same_thread=False)
+
+        segments = sorted(name for name in os.listdir(self.directory) if name.startswith("chat-"))
+        if segments:
+            self._open_segment(os.path.join(self.directory, segments[-1]))
+        print(f"[LOG] Chat log ready in {self.directory} (resuming after seq {self.start_seq})")
+
+    def _reserve(self, seq):
+        """Persist a new reservation; takes effect with the next commit"""
+        self.db.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('reserved_seq', ?)", (seq,))
+        self.reserved_seq = seq
+
+    def tail(self, count):
+        """The newest count lines, oldest first, for warming the history buffer after a restart"""
+        rows = self.db.execute(
+            "SELECT rowid, ts, author, text FROM messages ORDER BY rowid DESC LIMIT ?", (count,)
+        ).fetchall()
+        return [tuple(row) for row in reversed(rows)]
+
+    def can_assign(self, seq):
+        """Whether seq is covered by a written reservation (always, when the log is off)"""
+        return self.db is None or seq <= self.reserved_seq
+
+    def append(self, entry):
+        """Buffer a (seq, ts, author, text) entry; nothing touches disk on the event loop"""
+        if self.db is not None:
+            self.pending.append(entry)
+            self.last_seq = entry[0]
+
+    async def run(self):
+        """Background task: flush buffered lines to disk in batches"""
+        try:
+            while True:
+                await asyncio.sleep(CHAT_LOG_FLUSH_INTERVAL)
+                if self.pending:
+                    batch, self.pending = self.pending, []
+                    try:
+                        await asyncio.to_thread(self._write_batch, batch)
+                    except Exception as e:
+                        # Put the lines back in front; they go out with the next flush
+                        self.pending[:0] = batch
+                        overflow = len(self.pending) - CHAT_LOG_MAX_PENDING
+                        if overflow > 0:
+                            del self.pending[:overflow]
+                            self.dropped.inc(overflow)
+                        print(f"[LOG] Failed to write chat log ({len(self.pending)} lines pending): {e}")
+                        try:
+                            # The reservation is a single row, so it may still go through on its own
+                            await asyncio.to_thread(self._extend_reservation)
+                        except Exception as e:
+                            print(f"[LOG] Failed to extend the seq reservation past {self.reserved_seq}: {e}")
+        finally:
+            if self.pending:
+                self._write_batch(self.pending)
+                self.pending = []
+            # Every id handed out is now in the index (or was dropped), so the next run need not skip past the reservation
+            with self.write_lock:
+                self._reserve(self.last_seq)
+                self.db.commit()
+
+    def _open_segment(self, path):
+        if self.segment:
+            self.segment.close()
+        self.segment_path = path
+        self.segment = open(path, "a", encoding="utf-8")
+
+    def _extend_reservation(self):
+        """Blocking: move the reservation SEQ_RESERVE past the newest id when it runs low"""
+        with self.write_lock:
+            reserved = self.reserved_seq
+            if self.last_seq + self.SEQ_RESERVE // 2 <= reserved:
+                return
+            try:
+                self._reserve(self.last_seq + self.SEQ_RESERVE)
+                self.db.commit()
+            except Exception:
+                self.db.rollback()
+                self.reserved_seq = reserved
+                raise
+
+    def _write_batch(self, batch):
+        with self.write_lock:
+            reserved = self.reserved_seq
+            try:
+                self.db.executemany(
+                    "INSERT INTO messages(rowid, ts, author, text) VALUES (?, ?, ?, ?)", batch
+                )
+                if batch[-1][0] + self.SEQ_RESERVE // 2 > reserved:
+                    self._reserve(batch[-1][0] + self.SEQ_RESERVE)
+                if self.segment is None or self.segment.tell() >= CHAT_LOG_SEGMENT_BYTES:
+                    self._open_segment(os.path.join(self.directory, f"chat-{batch[0][0]:010d}.jsonl"))
+                self.segment.write("".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in batch))
+                self.segment.flush()
+                self.db.commit()
+            except Exception:
+                # Nothing from a failed batch stays in the index, so it can be retried as a whole
+                self.db.rollback()
+                self.reserved_seq = reserved
+                raise
+
+    def search(self, query, limit=50):
+        """Newest lines matching every word of query (a trailing * allows prefix matches)"""
+        terms = []
+        for word in query.split():
+            prefix = word.endswith("*")
+            word = word.rstrip("*").replace('"', '""')
+            if word:
+                terms.append(f'"{word}"' + ("*" if prefix else ""))
+        if not terms or self.reader is None:
+            return []
+        with self.read_lock:
+            rows = self.reader.execute(
+                "SELECT rowid, ts, author, text FROM messages WHERE messages MATCH ? "
+                "ORDER BY rowid DESC LIMIT ?",
+                (" ".join(terms), limit)
+            ).fetchall()
+        return [{"seq": seq, "ts": ts, "author": author, "text": text} for seq, ts, author, text in rows]
+
+chat_log = ChatLog(CHAT_LOG_DIR)
+
+# === CHAT HISTORY ===
+class ChatHistory:
+    """Bounded ring buffer of recent chat lines, replayed to clients on (re)connect.
+
+    Each line is a compact (seq, timestamp, author, text) tuple. Sequence ids
+    increase but can skip after a restart, so the lines after a given id are
+    found by a bisect on seq rather than by scanning.
+    """
+    def __init__(self, size=CHAT_HISTORY_SIZE):
+        self.entries = deque(maxlen=size)
+        self.last_seq = 0
+        self.evicted_seq = 0  # Newest seq no longer in the buffer
+
+    def load(self, entries, last_seq):
+        """Warm the buffer from the log after a restart"""
+        self.entries.extend(entries)
+        if self.entries:
+            self.evicted_seq = self.entries[0][0] - 1
+        self.last_seq = max(last_seq, self.entries[-1][0] if self.entries else 0)
+
+    def append(self, author, text):
+        self.last_seq += 1
+        entry = (self.last_seq, int(time.time()), author, text)
+        if len(self.entries) == self.entries.maxlen:
+            self.evicted_seq = self.entries[0][0]
+        self.entries.append(entry)
+        return entry
+
+    def since(self, seq):
+        """Lines newer than seq, plus whether some were already evicted"""
+        if not self.entries or seq >= self.last_seq:
+            return [], False
+        start = bisect_right(self.entries, seq, key=itemgetter(0))
+        return list(islice(self.entries, start, None)), seq < self.evicted_seq
+
+    def replay_frame(self, seq=None):
+        """One batched frame with everything a client missed (or the recent tail for new clients)"""
+        if seq is None:
+            messages, truncated = list(islice(self.entries, max(len(self.entries) - CHAT_HISTORY_REPLAY, 0), None)), False
+        else:
+            messages, truncated = self.since(seq)
+        return make_frame("history", {"messages": messages, "truncated": truncated}, seq=self.last_seq)
+
+chat_history = ChatHistory()
+
+if DISCORD_ENABLED:
+    # Continue sequence ids (and the replay buffer) from where the last run stopped
+    chat_log.open()
+    chat_history.load(chat_log.tail(CHAT_HISTORY_SIZE), chat_log.start_seq)
+
+def publish_chat(author, text):
+    """Record a chat line and fan it out to every /ws client as a chat envelope"""
+    if not chat_log.can_assign(chat_history.last_seq + 1):
+        # The log couldn't write a new id reservation: relay the line without an id rather than risk reusing one
+        chat_unrecorded.inc()
+        connections.broadcast(make_frame("chat", {"text": text}, sender=author))
+        return
+    entry = chat_history.append(author, text)
+    chat_log.append(entry)
+    seq, ts, _, _ = entry
+    connections.broadcast(make_frame("chat", {"text": text}, sender=author, seq=seq, ts=ts))
+
+# === POLLS ===
+class PollStore:
+    """Open polls with a TTL, a cap on how many stay open, and a JSON snapshot on disk.
+
+    Up/down tallies are kept as running counters next to the per-user votes,
+    so a vote costs O(1). Votes are coalesced per poll for POLL_VOTE_TICK
+    seconds and go out as a single poll_delta frame per tick; "sent_up" and
+    "sent_down" remember what clients have been told so far.
+    """
+    def __init__(self, hub, path=POLL_SNAPSHOT_PATH, ttl=POLL_TTL, max_open=POLL_MAX_OPEN):
+        self.hub = hub
+        self.path = path
+        self.ttl = ttl
+        self.max_open = max_open
+        self.polls = {}  # poll_id -> {question, creator, timestamp, votes, up, down, sent_up, sent_down, pending}; oldest first
+        self.dirty = False
+        self.changed = set()  # poll_ids with votes not yet broadcast
+        self.flush_handle = None
+
+    def load(self):
+        """Restore open polls from the last snapshot, skipping any that expired meanwhile"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"[POLL] Error loading poll snapshot: {e}")
+            return
+        if not isinstance(saved, dict):
+            print("[POLL] Error loading poll snapshot: not a JSON object")
+            return
+        cutoff = time.time() - self.ttl
+        for poll_id, poll in saved.items():
+            try:
+                timestamp = float(poll["timestamp"])
+                if not timestamp >= cutoff:  # Also drops NaN
+                    continue
+                votes = {str(user): vote for user, vote in poll["votes"].items() if vote in ("up", "down")}
+                up = sum(1 for v in votes.values() if v == "up")
+                self.polls[poll_id] = {
+                    "question": str(poll["question"]),
+                    "creator": str(poll["creator"]),
+                    "timestamp": timestamp,
+                    "votes": votes,
+                    "up": up,
+                    "down": len(votes) - up,
+                    "sent_up": up,
+                    "sent_down": len(votes) - up,
+                    "pending": {},
+                }
+            except Exception as e:
+                print(f"[POLL] Skipping bad poll {poll_id!r} in snapshot: {e!r}")
+        print(f"[POLL] Restored {len(self.polls)} open polls")
+
+    def frame(self, poll_id):
+        """Full poll frame with the tallies as of the last tick, so later deltas apply cleanly"""
+        poll = self.polls[poll_id]
+        return make_frame("poll", {
+            "poll_id": poll_id,
+            "question": poll["question"],
+            "creator": poll["creator"],
+            "up": poll["sent_up"],
+            "down": poll["sent_down"],
+        }, sender=poll["creator"], ts=int(poll["timestamp"]))
+
+    def create(self, question, creator):
+        poll_id = f"poll_{int(time.time())}_{secrets.token_urlsafe(8)}"
+        self.polls[poll_id] = {
+            "question": question,
+            "creator": creator,
+            "timestamp": time.time(),
+            "votes": {},
+            "up": 0,
+            "down": 0,
+            "sent_up": 0,
+            "sent_down": 0,
+            "pending": {},  # username -> vote since the last tick
+        }
+        self.dirty = True
+        self.hub.broadcast(self.frame(poll_id))
+        while len(self.polls) > self.max_open:
+            self.close(next(iter(self.polls)))
+        return poll_id
+
+    def vote(self, poll_id, username, vote):
+        """Record a vote for the next tick's delta; returns False for unknown polls or bad votes"""
+        poll = self.polls.get(poll_id)
+        if poll is None or vote not in ("up", "down"):
+            return False
+        previous = poll["votes"].get(username)
+        if previous == vote:
+            return True
+        if previous:
+            poll[previous] -= 1
+        poll[vote] += 1
+        poll["votes"][username] = vote
+        poll["pending"][username] = vote
+        self.dirty = True
+        self.changed.add(poll_id)
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(POLL_VOTE_TICK, self._flush_votes)
+        return True
+
+    def _flush_votes(self):
+        """One delta frame per changed poll: how far the tallies moved this tick, and who voted"""
+        self.flush_handle = None
+        changed, self.changed = self.changed, set()
+        for poll_id in changed:
+            poll = self.polls.get(poll_id)
+            if poll is None or not poll["pending"]:
+                continue
+            self.hub.broadcast(make_frame("poll_delta", {
+                "poll_id": poll_id,
+                "up": poll["up"] - poll["sent_up"],
+                "down": poll["down"] - poll["sent_down"],
+                "voters": poll["pending"],
+            }))
+            poll["sent_up"] = poll["up"]
+            poll["sent_down"] = poll["down"]
+            poll["pending"] = {}
+
+    def close(self, poll_id):
+        self.changed.discard(poll_id)
+        if self.polls.pop(poll_id, None) is not None:
+            self.dirty = True
+            self.hub.broadcast(make_frame("poll_closed", {"poll_id": poll_id}))
+
+    def expire(self):
+        cutoff = time.time() - self.ttl
+        for poll_id in [pid for pid, poll in self.polls.items() if poll["timestamp"] < cutoff]:
+            self.close(poll_id)
+
+    def _snapshot(self, polls):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(polls, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+
+    def _snapshot_copy(self):
+        return {
+            poll_id: {key: poll[key] for key in ("question", "creator", "timestamp")} | {"votes": dict(poll["votes"])}
+            for poll_id, poll in self.polls.items()
+        }
+
+    async def run(self):
+        """Background task: close expired polls and snapshot changes to disk"""
+        try:
+            while True:
+                await asyncio.sleep(POLL_SWEEP_INTERVAL)
+                self.expire()
+                if self.dirty:
+                    self.dirty = False
+                    try:
+                        await asyncio.to_thread(self._snapshot, self._snapshot_copy())
+                    except Exception as e:
+                        self.dirty = True
+                        print(f"[POLL] Failed to snapshot polls: {e}")
+        finally:
+            if self.dirty:
+                self._snapshot(self._snapshot_copy())
+
+poll_store = PollStore(connections)
+
+if DISCORD_ENABLED:
+    poll_store.load()
 
 # === DISCORD BOT SETUP ===
 if DISCORD_ENABLED:
@@ -103,11 +1733,24 @@ if DISCORD_ENABLED:
 
     @app.get("/callback")
     async def callback(request: Request):
+        started = time.perf_counter()
+        try:
+            response, result = await complete_oauth(request)
+        except Exception:
+            oauth_callbacks["error"].inc()
+            raise
+        finally:
+            oauth_callback_seconds.observe_since(started)
+        oauth_callbacks[result].inc()
+        return response
+
+    async def complete_oauth(request):
+        """Exchange the OAuth code and check guild membership; returns (response, outcome)"""
         code  = request.query_params.get("code")
         state = request.query_params.get("state")
 
         if state not in oauth_states:
-            return HTMLResponse("Invalid state", status_code=400)
+            return HTMLResponse("Invalid state", status_code=400), "invalid_state"
 
         data = {
             "client_id": CLIENT_ID,
@@ -127,7 +1770,7 @@ if DISCORD_ENABLED:
             access_token = token_json.get("access_token")
 
         if not access_token:
-            return HTMLResponse("Token exchange failed", status_code=400)
+            return HTMLResponse("Token exchange failed", status_code=400), "token_failed"
 
         async with httpx.AsyncClient() as client:
             user_resp = await client.get(
@@ -145,7 +1788,7 @@ if DISCORD_ENABLED:
 
         if member_resp.status_code != 200:
             print("[!] Member check failed — user is not in the guild or bot lacks permissions.")
-            return HTMLResponse("Not a guild member", status_code=403)
+            return HTMLResponse("Not a guild member", status_code=403), "not_member"
 
         member = member_resp.json()
         display_name = member.get("nick") or user.get("username")
@@ -159,19 +1802,44 @@ if DISCORD_ENABLED:
 
         token = jwt.encode(payload, JWT_SECRET, algorithm="HS256")
         oauth_states[state] = token
-        return HTMLResponse("<h3>Authentication successful! You can close this window.</h3>")
+        return HTMLResponse("<h3>Authentication successful! You can close this window.</h3>"), "ok"
 
     @app.get("/token")
     async def get_token(state: str):
         token = oauth_states.get(state)
         return {"token": token}
     
+    @app.get("/discord/stats")
+    async def get_discord_stats():
+        """Queue depth and flush latency of the outbound Discord relay"""
+        return discord_relay.stats()
+
     @app.get("/dkp")
     async def get_dkp(username: str):
         """Get DKP for a specific user"""
-        dkp = get_user_dkp(username)
+        await dkp_store.refresh()
+        dkp = dkp_store.get(username)
         return {"username": username, "dkp": dkp}
 
+    @app.get("/dkp/batch")
+    async def get_dkp_batch(usernames: str = ""):
+        """Get DKP for a comma-separated list of users (or everyone when empty)"""
+        await dkp_store.refresh()
+        names = [name.strip() for name in usernames.split(",") if name.strip()]
+        if not names:
+            return {"dkp": dict(dkp_store.data)}
+        return {"dkp": dkp_store.get_many(names)}
+
+    @app.get("/history/search")
+    async def search_history(q: str, token: str, limit: int = 50):
+        """Full-text search over the persisted chat log"""
+        try:
+            jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
+        except JWTError:
+            return JSONResponse({"error": "Invalid token"}, status_code=401)
+        results = await asyncio.to_thread(chat_log.search, q, min(max(limit, 1), 200))
+        return {"query": q, "results": results}
+
     @app.websocket("/ws")
     async def websocket_endpoint(websocket: WebSocket):
         global channel_ref
@@ -184,109 +1852,140 @@ if DISCORD_ENABLED:
             return
 
         connections.add(websocket)
+
+        # Replay what the client missed; must be queued before any await so no live line slips in between
+        try:
+            since = int(websocket.query_params["since"])
+        except (KeyError, ValueError):
+            since = None
+        connections.send(websocket, chat_history.replay_frame(since))
+
+        user_key = data['username'].lower()
+        chat_sockets.setdefault(user_key, set()).add(websocket)
+
+        # Current DKP goes out on connect; later changes are pushed by the DKP watcher
+        connections.send(websocket, make_frame("dkp", {"dkp": dkp_store.get(user_key)}))
+
+        presence.join(data['username'])
+        connections.send(websocket, presence.snapshot())
+
+        # Polls that are still open
+        for poll_id in poll_store.polls:
+            connections.send(websocket, poll_store.frame(poll_id))
         try:
             while True:
-                text = await websocket.receive_text()
-                
-                # Check if it's a JSON message (poll command)
+                message = await websocket.receive_text()
+                started = time.perf_counter()
                 try:
-                    json_data = json.loads(text)
-                    if json_data.get("type") == "poll_create":
-                        # Handle poll creation
-                        poll_id = f"poll_{int(time.time())}_{secrets.token_urlsafe(8)}"
-                        active_polls[poll_id] = {
-                            "question": json_data["question"],
-                            "votes": {},
-                            "creator": data['username'],
-                            "timestamp": time.time()
-                        }
-                        
-                        # Broadcast poll to all clients
-                        poll_msg = json.dumps({
-                            "type": "poll",
-                            "poll_id": poll_id,
-                            "question": json_data["question"],
-                            "creator": data['username'],
-                            "votes": {}
-                        })
-                        
-                        for conn in connections.copy():
-                            try:
-                                await conn.send_text(poll_msg)
-                            except:
-                                connections.discard(conn)
-                        
+                    kind, body = decode_client_frame(message)
+
+                    if kind == "chat":
+                        ws_messages["chat"].inc()
+                        text = body.get("text")
+                        if not isinstance(text, str) or not text:
+                            continue
+
+                        # Send to WebSocket clients (the sender included, so they see their own message)
+                        publish_chat(data['username'], text)
+
                         # Send to Discord channel
-                        if channel_ref:
-                            try:
-                                await channel_ref.send(f"📊 **Poll from {data['username']}:** {json_data['question']}")
-                            except Exception as e:
-                                print(f"[!] Failed to send poll to Discord: {e}")
-                        continue
-                    
-                    elif json_data.get("type") == "poll_vote":
-                        # Handle poll vote
-                        poll_id = json_data["poll_id"]
-                        vote = json_data["vote"]  # "up" or "down"
-                        
-                        if poll_id in active_polls:
-                            active_polls[poll_id]["votes"][data['username']] = vote
-                            
-                            # Broadcast vote update to all clients
-                            vote_msg = json.dumps({
-                                "type": "poll_update",
-                                "poll_id": poll_id,
-                                "votes": active_polls[poll_id]["votes"]
-                            })
-                            
-                            for conn in connections.copy():
-                                try:
-                                    await conn.send_text(vote_msg)
-                                except:
-                                    connections.discard(conn)
-                        continue
-                    
-                except (json.JSONDecodeError, KeyError):
-                    # Not a JSON message or not a poll command, treat as regular message
-                    pass
-                
-                msg = f"[{data['username']}] {text}"
+                        discord_relay.enqueue(f"[{data['username']}] {text}")
 
-                # Send to WebSocket clients
-                # First, send to the sender (so they see their own message)
-                try:
-                    await websocket.send_text(msg)
-                except:
-                    connections.discard(websocket)
+                    elif kind == "poll_create":
+                        ws_messages["poll_create"].inc()
+                        question = body.get("question")
+                        if not isinstance(question, str) or not question:
+                            continue
 
-                # Then send to all *other* clients
-                for conn in connections.copy():
-                    if conn != websocket:
-                        try:
-                            await conn.send_text(msg)
-                        except:
-                            connections.discard(conn)
+                        # Handle poll creation (broadcasts the new poll to all clients)
+                        poll_store.create(question, data['username'])
 
-                # Send to Discord channel
-                if channel_ref:
-                    try:
-                        await channel_ref.send(msg)
-                    except Exception as e:
-                        print(f"[!] Failed to send to Discord: {e}")
+                        # Send to Discord channel
+                        discord_relay.enqueue(f"📊 **Poll from {data['username']}:** {question}")
+
+                    elif kind == "poll_vote":
+                        ws_messages["poll_vote"].inc()
+                        # Handle poll vote ("up" or "down"); the new tally goes out with the next tick
+                        poll_store.vote(body.get("poll_id"), data['username'], body.get("vote"))
+
+                finally:
+                    ws_handle_seconds.observe_since(started)
         except Exception:
             pass
         finally:
             connections.discard(websocket)
+            presence.leave(data['username'])
+            user_sockets = chat_sockets.get(user_key)
+            if user_sockets:
+                user_sockets.discard(websocket)
+                if not user_sockets:
+                    del chat_sockets[user_key]
+
+@app.get("/online_count")
+async def online_count(response: Response):
+    """Number of unique authenticated users on /ws"""
+    response.headers["Cache-Control"] = "public, max-age=5"
+    return {"online": presence.count()}
 
 @app.get("/map")
-async def serve_map():
-    """Serve the map client HTML file"""
+async def serve_map(request: Request):
+    """Serve the map client HTML file (from memory; revalidated with its ETag)"""
+    page = await map_page.get()
+    if page is None:
+        return HTMLResponse("<h1>Map client not found</h1>", status_code=404)
+    return asset_response(request, page, "no-cache")
+
+@app.get("/metrics")
+async def get_metrics():
+    """Counters, gauges and histograms in Prometheus' text format"""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/map/latency")
+async def get_map_latency():
+    """Sampled ping latency (ms) from server receive to client receive: p50/p95/p99 overall and per /map client"""
+    return map_latency.stats()
+
+@app.get("/static/{name:path}")
+async def serve_static(name: str, request: Request):
+    """Serve a file from ASSETS_DIR by its content-hashed or plain name"""
+    await asset_store.refresh()
+    asset, cache_control = asset_store.lookup(name)
+    if asset is None:
+        return Response(status_code=404)
+    return asset_response(request, asset, cache_control)
+
+@app.get("/pois")
+async def get_pois(request: Request, layer: str, bbox: str = ""):
+    """POIs of one layer, all of them or only those inside bbox=min_x,min_y,max_x,max_y (map pixels)"""
+    await poi_store.refresh()
+    if layer not in poi_store.layers:
+        return JSONResponse({"error": "Unknown layer"}, status_code=404)
+    entry = poi_store.layers[layer]
+    if not bbox:
+        return asset_response(request, entry["asset"], "no-cache")
     try:
-        with open("map_client.html", "r", encoding="utf-8") as f:
-            content = f.read()
-        return HTMLResponse(content)
+        box = parse_bbox(bbox)
+    except ValueError:
+        return JSONResponse({"error": "bbox must be min_x,min_y,max_x,max_y"}, status_code=400)
+    # The answer for a given URL only changes with the layer, so its hash is a valid ETag
+    headers = {"Cache-Control": "no-cache", "ETag": f'"{entry["version"]}"'}
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse({"layer": layer, "pois": poi_store.query(layer, box)}, headers=headers)
+
+@app.get("/tiles/{z}/{x}/{y}")
+async def serve_tile(z: int, x: int, y: int, request: Request):
+    """Serve one 256-px map tile generated by make_tiles.py"""
+    path = os.path.join(TILES_DIR, str(z), str(x), f"{y}.png")
+    try:
+        stat = os.stat(path)
     except FileNotFoundError:
-        return HTMLResponse("<h1>Map client not found</h1>", status_code=404)
+        return Response(status_code=404)
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {"Cache-Control": f"public, max-age={TILE_CACHE_SECONDS}", "ETag": etag}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type="image/png", headers=headers, stat_result=stat)
 
 @app.websocket("/map")
 async def map_websocket_endpoint(websocket: WebSocket):
@@ -299,67 +1998,98 @@ async def map_websocket_endpoint(websocket: WebSocket):
     
     try:
         while True:
-            message = await websocket.receive_text()
-            data = json.loads(message)
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+
+            started = time.perf_counter()
+            try:
+                if message.get("bytes") is not None:
+                    map_messages["ping"].inc()
+                    # Compact ping from a bin2 client; the sender is whoever joined on this socket
+                    if user_data["username"] and len(message["bytes"]) == MAP_PING_IN.size:
+                        op, lat, lng = MAP_PING_IN.unpack(message["bytes"])
+                        # NaN or inf would break the tick's flush for everyone, so they stop here
+                        if op == MAP_OP_PING and math.isfinite(lat) and math.isfinite(lng):
+                            map_pings.add(user_data["username"], lat, lng)
+                    continue
+
+                data = json.loads(message["text"])
             
-            if data["type"] == "join":
-                user_data["username"] = data["user"]
+                if data["type"] == "join":
+                    map_messages["join"].inc()
+                    # Not counted in presence: /map names are unverified
+                    user_data["username"] = str(data["user"])[:MAP_MAX_NAME_LENGTH]
                 
-                # Get current user list
-                user_list = []
-                for conn in map_connections:
-                    if hasattr(conn, 'user_data') and conn.user_data.get("username"):
-                        user_list.append(conn.user_data["username"])
+                    # Get current user list
+                    user_list = []
+                    for conn in map_connections:
+                        if hasattr(conn, 'user_data') and conn.user_data.get("username"):
+                            user_list.append(conn.user_data["username"])
                 
-                # Send current user list to new user
-                await websocket.send_text(json.dumps({
-                    "type": "user_list",
-                    "users": user_list
-                }))
-                
-                # Notify others of new user
-                for conn in map_connections.copy():
-                    if conn != websocket:
-                        try:
-                            await conn.send_text(json.dumps({
-                                "type": "user_joined",
-                                "user": user_data["username"]
-                            }))
-                        except:
-                            map_connections.discard(conn)
+                    # Send current user list to new user, with the ping encoding picked from what it offered
+                    encoding = map_codec.negotiate(websocket, data.get("encodings"))
+                    map_latency.join(websocket, data.get("clock"))
+                    map_connections.send(websocket, encode_frame({
+                        "type": "user_list",
+                        "users": user_list,
+                        "encoding": encoding,
+                        "ack_every": MAP_ACK_SAMPLE
+                    }))
+                    if encoding == "bin2":
+                        map_codec.send_table(websocket)
                 
-            elif data["type"] == "ping":
-                # Broadcast ping to all other connected map users
-                ping_data = {
-                    "type": "ping",
-                    "user": data["user"],
-                    "lat": data["lat"],
-                    "lng": data["lng"],
-                    "timestamp": data["timestamp"]
-                }
+                    # Notify others of new user
+                    map_connections.broadcast_json({
+                        "type": "user_joined",
+                        "user": user_data["username"]
+                    }, exclude=websocket)
                 
-                for conn in map_connections.copy():
-                    if conn != websocket:  # Don't send back to sender
-                        try:
-                            await conn.send_text(json.dumps(ping_data))
-                        except:
-                            map_connections.discard(conn)
+                elif data["type"] == "ping":
+                    map_messages["ping"].inc()
+                    # Goes out to every map user with the next tick's batch; clients skip their own pings.
+                    # Like binary pings, the sender is whoever joined on this socket
+                    lat, lng = float(data["lat"]), float(data["lng"])
+                    if user_data["username"] and math.isfinite(lat) and math.isfinite(lng):
+                        map_pings.add(user_data["username"], lat, lng)
+
+                elif data["type"] == "ack":
+                    map_messages["ack"].inc()
+                    # Sampled receipt of a ping we stamped
+                    try:
+                        timestamp, received = float(data["timestamp"]), float(data["received"])
+                    except (KeyError, TypeError, ValueError):
+                        continue
+                    if math.isfinite(timestamp) and math.isfinite(received):
+                        map_latency.ack(websocket, timestamp, received)
+
+                elif data["type"] == "viewport":
+                    map_messages["viewport"].inc()
+                    # From now on only pings near these bounds are delivered to this client
+                    south, west, north, east = bounds = tuple(float(value) for value in data["bounds"])
+                    if not all(map(math.isfinite, bounds)):
+                        continue
+                    map_views.update(websocket, south, west, north, east, bool(data.get("snap")))
+
+                else:
+                    map_messages["other"].inc()
+            finally:
+                map_handle_seconds.observe_since(started)
     
     except Exception as e:
         pass  # Connection closed
     finally:
         map_connections.discard(websocket)
+        map_codec.discard(websocket)
+        map_views.discard(websocket)
+        map_latency.discard(websocket)
         
         # Notify others that user left
         if user_data["username"]:
-            for conn in map_connections.copy():
-                try:
-                    await conn.send_text(json.dumps({
-                        "type": "user_left",
-                        "user": user_data["username"]
-                    }))
-                except:
-                    map_connections.discard(conn)
+            map_connections.broadcast_json({
+                "type": "user_left",
+                "user": user_data["username"]
+            })
 
 # === DISCORD BOT EVENTS ===
 if DISCORD_ENABLED and bot:
@@ -382,17 +2112,12 @@ if DISCORD_ENABLED and bot:
         if message.channel.id != CHANNEL_ID:
             return
 
-        msg = f"[{message.author.display_name}] {message.content}"
-        for conn in connections.copy():
-            try:
-                await conn.send_text(msg)
-            except:
-                connections.discard(conn)
+        publish_chat(message.author.display_name, message.content)
 
 
 # === MAIN ENTRY ===
 async def main():
-    config = uvicorn.Config(app, host="0.0.0.0", port=8800, log_level="info")
+    config = uvicorn.Config(app, host="0.0.0.0", port=8800, log_level="info", **WS_SETTINGS)
     server = uvicorn.Server(config)
 
     tasks = [server.serve()]
@@ -401,6 +2126,10 @@ async def main():
         print("[INFO] Starting with Discord integration")
         bot_task = asyncio.create_task(bot.start(BOT_TOKEN))
         tasks.append(bot_task)
+        tasks.append(asyncio.create_task(discord_relay.run()))
+        tasks.append(asyncio.create_task(watch_dkp()))
+        tasks.append(asyncio.create_task(chat_log.run()))
+        tasks.append(asyncio.create_task(poll_store.run()))
     else:
         print("[INFO] Starting in map-only mode (Discord integration disabled)")
     
@@ -0,0 +1,27 @@
+"""Client frame decoding on /ws, including what older clients send"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server  # noqa: E402
+
+
+def test_envelope():
+    frame = json.dumps({"v": 1, "type": "chat", "body": {"text": "hi"}})
+    assert server.decode_client_frame(frame) == ("chat", {"text": "hi"})
+
+
+def test_bare_text_is_chat():
+    assert server.decode_client_frame("gg") == ("chat", {"text": "gg"})
+    assert server.decode_client_frame("{not json") == ("chat", {"text": "{not json"})
+
+
+def test_legacy_poll_command():
+    frame = json.dumps({"type": "poll_vote", "poll_id": "p1", "vote": "up"})
+    assert server.decode_client_frame(frame) == ("poll_vote", {"type": "poll_vote", "poll_id": "p1", "vote": "up"})
+
+
+def test_json_without_known_type_is_relayed_as_chat():
+    for text in ('{"a": 1}', '{"type": "system", "text": "x"}', '{"type": ["chat"]}'):
+        assert server.decode_client_frame(text) == ("chat", {"text": text})
@@ -0,0 +1,33 @@
+"""Conditional requests and asset lookup for /static"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import server  # noqa: E402
+
+
+def test_etag_matches_list_and_weak_tags():
+    etag = '"abc123-gzip"'
+    assert server.etag_matches('"abc123-gzip"', etag)
+    assert server.etag_matches('W/"abc123-gzip"', etag)
+    assert server.etag_matches('"old", W/"abc123-gzip" , "other"', etag)
+    assert server.etag_matches(" * ", etag)
+    assert not server.etag_matches('"abc123"', etag)
+    assert not server.etag_matches("", etag)
+    assert not server.etag_matches(None, etag)
+
+
+def test_legacy_assets_fall_back(tmp_path):
+    static = tmp_path / "static"
+    static.mkdir()
+    (static / "runes.js").write_text("var runes = [];")
+    (tmp_path / "light.wav").write_bytes(b"RIFF old")
+    store = server.AssetStore(str(static), str(tmp_path))
+    store.load()
+    assert set(store.assets) == {"runes.js", "light.wav"}
+    assert store.assets["light.wav"]["body"] == b"RIFF old"
+
+    # A copy in the assets directory wins over the legacy one
+    (static / "light.wav").write_bytes(b"RIFF new")
+    store.load()
+    assert store.assets["light.wav"]["body"] == b"RIFF new"